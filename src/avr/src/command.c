@@ -40,6 +40,7 @@
 #include "rtc.h"
 #include "stepper.h"
 #include "cpp_magic.h"
+#include "util.h"
 
 #include <util/atomic.h>
 
@@ -75,6 +76,12 @@ static struct {
 #undef CMD
 
 
+// Binary frame command callbacks
+stat_t command_line_frame(const uint8_t *, uint8_t);
+stat_t command_sync_speed_frame(const uint8_t *, uint8_t);
+stat_t command_sync_var_frame(const uint8_t *, uint8_t);
+
+
 // Name
 #define CMD(CODE, NAME, SYNC)                                   \
   static const char command_##NAME##_name[] PROGMEM = #NAME;
@@ -104,6 +111,30 @@ static stat_t _dispatch(char *s) {
 }
 
 
+static stat_t _dispatch_frame(const uint8_t *data, uint8_t length) {
+  switch (*data) {
+  case COMMAND_line:       return command_line_frame(data, length);
+  case COMMAND_sync_speed: return command_sync_speed_frame(data, length);
+  case COMMAND_sync_var:   return command_sync_var_frame(data, length);
+  }
+
+  return STAT_INVALID_COMMAND;
+}
+
+
+static stat_t _check_frame(const uint8_t *frame) {
+  // [start][length][payload][crc16]
+  uint8_t length = frame[1];
+  if (!length || INPUT_BUFFER_LEN < length + 4) return STAT_BAD_FRAME;
+
+  uint16_t crc;
+  memcpy(&crc, frame + 2 + length, sizeof(crc));
+  if (crc16(0xffff, frame + 1, length + 1) != crc) return STAT_BAD_FRAME_CRC;
+
+  return STAT_OK;
+}
+
+
 static unsigned _size(char code) {
   switch (code) {
 #define CMD(CODE, NAME, SYNC, ...)                                  \
@@ -137,6 +168,13 @@ bool command_is_active() {return cmd.active;}
 unsigned command_get_count() {return cmd.count;}
 
 
+void command_print_frames_json() {
+  // Commands accepted as binary frames
+  printf_P(PSTR("\"%c\",\"%c\",\"%c\""), COMMAND_line, COMMAND_sync_speed,
+           COMMAND_sync_var);
+}
+
+
 void command_print_json() {
   bool first = true;
   static const char fmt[] PROGMEM = "\"%c\":{\"name\":\"%" PRPSTR "\"}";
@@ -173,9 +211,27 @@ void command_push(char code, void *_data) {
 
 bool command_callback() {
   static char *block = 0;
-
-  if (!block) block = usart_readline();
-  if (!block) return false; // No command
+  static uint8_t length = 0; // Binary frame payload length
+
+  if (!block) {
+    block = usart_readline();
+    if (!block) return false; // No command
+    length = 0;
+
+    // Check binary frame and skip to its payload
+    if (*block == USART_FRAME_START) {
+      stat_t status = _check_frame((uint8_t *)block);
+
+      if (status) {
+        STATUS_ERROR(status, "");
+        block = 0;
+        return true;
+      }
+
+      length = block[1];
+      block += 2;
+    }
+  }
 
   stat_t status = STAT_OK;
 
@@ -189,7 +245,8 @@ bool command_callback() {
 
   // Dispatch non-empty commands
   if (*block && status == STAT_OK) {
-    status = _dispatch(block);
+    if (length) status = _dispatch_frame((uint8_t *)block, length);
+    else status = _dispatch(block);
     if (status == STAT_OK) cmd.active = true; // Disables LCD booting message
   }
 
@@ -197,7 +254,10 @@ bool command_callback() {
   case STAT_OK: break;
   case STAT_NOP: break;
   case STAT_MACHINE_ALARMED: STATUS_WARNING(status, ""); break;
-  default: STATUS_ERROR(status, "%s", block); break;
+  default:
+    if (length) STATUS_ERROR(status, "frame %c", *block);
+    else STATUS_ERROR(status, "%s", block);
+    break;
   }
 
   block = 0; // Command consumed
@@ -276,3 +336,11 @@ bool command_exec() {
 // Var callbacks
 uint16_t get_id() {return cmd.id;}
 void set_id(uint16_t id) {cmd.id = id;}
+
+
+uint16_t get_queue_free() {
+  // Room for line commands, each preceded by a command ID
+  unsigned slot = _size(COMMAND_line) + _size(COMMAND_sync_var) + 2;
+  unsigned space = sync_q_space();
+  return space ? (space - 1) / slot : 0;
+}
@@ -65,7 +65,9 @@ stat_t command_help(char *cmd) {
   command_print_json();
   printf_P(PSTR("},\"variables\":{"));
   vars_print_json();
-  printf_P(PSTR("}}\n"));
+  printf_P(PSTR("},\"frames\":["));
+  command_print_frames_json();
+  printf_P(PSTR("]}\n"));
 
   return STAT_OK;
 }
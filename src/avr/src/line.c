@@ -171,6 +171,27 @@ static stat_t _line_exec() {
 }
 
 
+static stat_t _queue_line(line_t *line) {
+  // Set next start position
+  command_set_position(line->target);
+
+  // Compute direction vector
+  for (int axis = 0; axis < AXES; axis++) {
+    line->unit[axis] = line->target[axis] - line->start[axis];
+    line->length += line->unit[axis] * line->unit[axis];
+  }
+
+  line->length = sqrt(line->length);
+  for (int axis = 0; axis < AXES; axis++)
+    if (line->unit[axis]) line->unit[axis] /= line->length;
+
+  // Queue
+  command_push(COMMAND_line, line);
+
+  return STAT_OK;
+}
+
+
 stat_t command_line(char *cmd) {
   line_t line = {};
 
@@ -216,23 +237,67 @@ stat_t command_line(char *cmd) {
   // Check for end of command
   if (*cmd) return STAT_INVALID_ARGUMENTS;
 
-  // Set next start position
-  command_set_position(line.target);
+  return _queue_line(&line);
+}
 
-  // Compute direction vector
-  for (int axis = 0; axis < AXES; axis++) {
-    line.unit[axis] = line.target[axis] - line.start[axis];
-    line.length += line.unit[axis] * line.unit[axis];
-  }
 
-  line.length = sqrt(line.length);
+// [code][flags][targetVel][maxAccel][maxJerk][axes][times]
+// Bits 0 to AXES - 1 of flags mark the axes present, the next 7 bits the times
+stat_t command_line_frame(const uint8_t *data, uint8_t length) {
+  line_t line = {};
+
+  const uint8_t *end = data + length;
+  data++; // Skip command code
+
+  // Get flags and check length
+  uint16_t flags;
+  if (length < 3) return STAT_BAD_FRAME;
+  memcpy(&flags, data, sizeof(flags));
+  data += sizeof(flags);
+
+  unsigned count = 3;
+  for (int i = 0; i < AXES + 7; i++)
+    if (flags & (1 << i)) count++;
+
+  if (data + count * sizeof(float) != end) return STAT_BAD_FRAME;
+
+  // Get start position
+  command_get_position(line.start);
+
+  // Get target velocity
+  if (!decode_frame_float(&data, &line.target_vel)) return STAT_BAD_FLOAT;
+  if (line.target_vel < 0) return STAT_INVALID_ARGUMENTS;
+
+  // Get max accel
+  if (!decode_frame_float(&data, &line.max_accel)) return STAT_BAD_FLOAT;
+  if (line.max_accel < 0) return STAT_INVALID_ARGUMENTS;
+
+  // Get max jerk
+  if (!decode_frame_float(&data, &line.max_jerk)) return STAT_BAD_FLOAT;
+  if (line.max_jerk < 0) return STAT_INVALID_ARGUMENTS;
+
+  // Get target position
+  copy_vector(line.target, line.start);
   for (int axis = 0; axis < AXES; axis++)
-    if (line.unit[axis]) line.unit[axis] /= line.length;
+    if (flags & (1 << axis) && !decode_frame_float(&data, &line.target[axis]))
+      return STAT_BAD_FLOAT;
 
-  // Queue
-  command_push(COMMAND_line, &line);
+  // Get times
+  bool has_time = false;
+  for (int section = 0; section < 7; section++) {
+    if (!(flags & (1 << (AXES + section)))) continue;
 
-  return STAT_OK;
+    float time;
+    if (!decode_frame_float(&data, &time)) return STAT_BAD_FLOAT;
+
+    if (time < 0) return STAT_NEGATIVE_SCURVE_TIME;
+    line.times[section] = time;
+    if (time) has_time = true;
+  }
+
+  if (!has_time) return STAT_ALL_ZERO_SCURVE_TIMES;
+
+  return _queue_line(&line);
 }
 
 
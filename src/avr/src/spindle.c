@@ -315,6 +315,24 @@ stat_t command_sync_speed(char *cmd) {
 }
 
 
+// [code][offset][speed]
+stat_t command_sync_speed_frame(const uint8_t *data, uint8_t length) {
+  sync_speed_t s;
+
+  if (length != 1 + 2 * sizeof(float)) return STAT_BAD_FRAME;
+  data++; // Skip command code
+
+  // Get distance and speed
+  if (!decode_frame_float(&data, &s.dist) || s.dist < 0) return STAT_BAD_FLOAT;
+  if (!decode_frame_float(&data, &s.speed))              return STAT_BAD_FLOAT;
+
+  // Queue
+  command_push(COMMAND_sync_speed, &s);
+
+  return STAT_OK;
+}
+
+
 unsigned command_sync_speed_size() {return sizeof(sync_speed_t);}
 
 
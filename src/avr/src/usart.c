@@ -246,6 +246,22 @@ char *usart_readline() {
   while (!rx_buf_empty()) {
     char data = usart_getc();
 
+    // Binary frames are read raw, they are checked by command_callback()
+    if (i && line[0] == USART_FRAME_START) {
+      line[i++] = data;
+
+      uint8_t length = line[1];
+      if (i == 2 && INPUT_BUFFER_LEN < length + 4) eol = true; // Too long
+      if (i == length + 4) eol = true;
+
+      if (eol) {
+        i = 0;
+        return line;
+      }
+
+      continue;
+    }
+
     switch (data) {
     case '\r': case '\n': eol = true; break;
     case '\b': if (i) i--; break; // BS - backspace
@@ -37,6 +37,9 @@
 #define USART_TX_RING_BUF_SIZE 1024
 #define USART_RX_RING_BUF_SIZE 1024
 
+// Starts a binary command frame: [start][length][payload][crc16]
+#define USART_FRAME_START 0x01 // SOH
+
 
 typedef enum {
   USART_BAUD_9600,
@@ -81,6 +81,25 @@ bool decode_float(char **s, float *f) {
 }
 
 
+bool decode_frame_float(const uint8_t **data, float *f) {
+  memcpy(f, *data, sizeof(float));
+  *data += sizeof(float);
+  return isfinite(*f);
+}
+
+
+/// CRC-16/CCITT, polynomial 0x1021 without reflection
+uint16_t crc16(uint16_t crc, const uint8_t *data, unsigned len) {
+  for (unsigned i = 0; i < len; i++) {
+    uint8_t x = (crc >> 8) ^ data[i];
+    x ^= x >> 4;
+    crc = (crc << 8) ^ ((uint16_t)x << 12) ^ ((uint16_t)x << 5) ^ x;
+  }
+
+  return crc;
+}
+
+
 stat_t decode_axes(char **cmd, float axes[AXES]) {
   while (**cmd) {
     const char *names = "xyzabc";
@@ -35,6 +35,7 @@
 #include "cpp_magic.h"
 #include "report.h"
 #include "command.h"
+#include "util.h"
 
 #include <string.h>
 #include <stdio.h>
@@ -392,6 +393,66 @@ stat_t command_sync_var(char *cmd) {
 }
 
 
+static type_u _frame_value(type_t type, char kind, const uint8_t *data,
+                           stat_t *status) {
+  type_u value;
+  int32_t i = 0;
+  float f = 0;
+
+  *status = STAT_OK;
+
+  if (kind == 'i') {
+    memcpy(&i, data, sizeof(i));
+    f = i;
+
+  } else if (kind == 'f') {
+    if (!decode_frame_float(&data, &f)) *status = STAT_BAD_FLOAT;
+    else i = f;
+
+  } else *status = STAT_BAD_FRAME;
+
+  switch (type) {
+  case TYPE_f32: value._f32 = f; break;
+  case TYPE_u8:  value._u8  = i; break;
+  case TYPE_s8:  value._s8  = i; break;
+  case TYPE_u16: value._u16 = i; break;
+  case TYPE_s32: value._s32 = i; break;
+  case TYPE_u32: value._u32 = i; break;
+  case TYPE_b8:  value._b8  = kind == 'f' ? f != 0 : i != 0; break;
+  default: *status = STAT_INVALID_TYPE;
+  }
+
+  return value;
+}
+
+
+// [code][kind: f|i][value: f32|s32][name]
+stat_t command_sync_var_frame(const uint8_t *data, uint8_t length) {
+  if (length < 7 || 10 < length) return STAT_BAD_FRAME;
+
+  // Get name
+  char name[5];
+  memcpy(name, data + 6, length - 6);
+  name[length - 6] = 0;
+
+  var_info_t info;
+  if (!_find_var(name, &info)) return STAT_UNRECOGNIZED_NAME;
+  if (!info.set.ptr) return STAT_READ_ONLY;
+
+  stat_t status;
+  var_cmd_t buffer;
+
+  buffer.type  = info.type;
+  buffer.index = info.index;
+  buffer.set   = info.set;
+  buffer.value = _frame_value(info.type, data[1], data + 2, &status);
+
+  if (status == STAT_OK) command_push(COMMAND_sync_var, &buffer);
+
+  return status;
+}
+
+
 unsigned command_sync_var_size() {return sizeof(var_cmd_t);}
 
 
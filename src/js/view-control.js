@@ -168,6 +168,7 @@ module.exports = {
 
     remaining() {
       if (!(this.is_stopping || this.is_running || this.is_holding)) return 0;
+      if (typeof this.state.remaining == 'number') return this.state.remaining;
       if (this.active.time < this.plan_time) return 0;
       return this.active.time - this.plan_time
     },
@@ -190,6 +191,7 @@ module.exports = {
       if (this.simulating) return this.active.progress;
 
       if (!this.active.time || this.is_ready) return 0;
+      if (typeof this.state.percent == 'number') return this.state.percent / 100;
       var p = this.plan_time / this.active.time;
       return p < 1 ? p : 1;
     }
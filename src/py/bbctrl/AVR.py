@@ -29,10 +29,25 @@ import serial
 import time
 import traceback
 import ctypes
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+
+from . import Cmd
 
 __all__ = ['AVR']
 
 
+# Control commands are sent ahead of variable and Modbus writes
+_urgent_cmds = (Cmd.ESTOP, Cmd.PAUSE, Cmd.STOP, Cmd.UNPAUSE, Cmd.FLUSH,
+                Cmd.CLEAR, Cmd.SHUTDOWN)
+
+I2C_RETRIES = 10
+I2C_BACKOFF = 0.01 # Doubles on each retry
+I2C_MAX_BACKOFF = 0.5
+
+
 class _serial_struct(ctypes.Structure):
     _fields_ = [
         ('type',            ctypes.c_int),
@@ -79,8 +94,16 @@ class AVR(object):
         self.read_cb = None
         self.write_cb = None
 
+        # I2C writes, with their retries, run on a worker thread
+        self.i2c_queue = queue.PriorityQueue()
+        self.i2c_seq = itertools.count() # Keeps FIFO order within a priority
+        self.i2c_keys = {} # Latest pending entry by coalescing key
+        self.i2c_lock = threading.Lock()
+        threading.Thread(target = self._i2c_worker, name = 'i2c',
+                         daemon = True).start()
+
 
-    def close(self): pass
+    def close(self): self.i2c_queue.put((-1, 0, None))
 
 
     def _start(self):
@@ -95,8 +118,8 @@ class AVR(object):
             self.log.warning('Failed to open serial port: %s', e)
 
         if self.sp is not None:
-            self.ctrl.ioloop.add_handler(self.sp, self._serial_handler,
-                                         self.ctrl.ioloop.READ)
+            self.ctrl.serial_ioloop.add_handler(self.sp, self._serial_handler,
+                                         self.ctrl.serial_ioloop.READ)
 
 
     def set_handlers(self, read_cb, write_cb):
@@ -111,9 +134,9 @@ class AVR(object):
     def enable_write(self, enable):
         if self.sp is None: return
 
-        flags = self.ctrl.ioloop.READ
-        if enable: flags |= self.ctrl.ioloop.WRITE
-        self.ctrl.ioloop.update_handler(self.sp, flags)
+        flags = self.ctrl.serial_ioloop.READ
+        if enable: flags |= self.ctrl.serial_ioloop.WRITE
+        self.ctrl.serial_ioloop.update_handler(self.sp, flags)
 
 
     def _serial_write(self):
@@ -132,31 +155,71 @@ class AVR(object):
 
     def _serial_handler(self, fd, events):
         try:
-            if self.ctrl.ioloop.READ & events: self._serial_read()
-            if self.ctrl.ioloop.WRITE & events: self._serial_write()
+            if self.ctrl.serial_ioloop.READ & events: self._serial_read()
+            if self.ctrl.serial_ioloop.WRITE & events: self._serial_write()
 
         except Exception as e:
             self.log.warning('Serial handler error: %s', traceback.format_exc())
 
 
-    def i2c_command(self, cmd, byte = None, word = None, block = None):
+    def i2c_command(self, cmd, byte = None, word = None, block = None,
+                    key = None):
         self.log.info('I2C: %s b=%s w=%s d=%s' % (cmd, byte, word, block))
-        retry = 10
-        cmd = ord(cmd[0])
+
+        future = Future()
+        entry = [key, (cmd, byte, word, block), future]
+        priority = 0 if cmd in _urgent_cmds else 1
+
+        with self.i2c_lock:
+            if key is not None:
+                # Only the latest pending write with the same key is sent
+                old = self.i2c_keys.get(key)
+                if old is not None:
+                    old[2].set_result(None)
+                    old[2] = None
+
+                self.i2c_keys[key] = entry
+
+            self.i2c_queue.put((priority, next(self.i2c_seq), entry))
+
+        return future
+
+
+    def _i2c_write(self, cmd, byte, word, block):
+        retry = 0
 
         while True:
             try:
-                self.ctrl.i2c.write(self.i2c_addr, cmd, byte, word, block)
-                break
+                self.ctrl.i2c.write(self.i2c_addr, ord(cmd[0]), byte, word,
+                                    block)
+                return
 
             except Exception as e:
-                retry -= 1
+                retry += 1
 
-                if retry:
+                if retry < I2C_RETRIES:
                     self.log.warning('I2C failed, retrying: %s' % e)
-                    time.sleep(0.25)
+                    time.sleep(min(I2C_BACKOFF * 2 ** retry, I2C_MAX_BACKOFF))
                     continue
 
-                else:
-                    self.log.error('I2C failed: %s' % e)
-                    raise
+                self.log.error('I2C failed: %s' % e)
+                raise
+
+
+    def _i2c_worker(self):
+        while True:
+            entry = self.i2c_queue.get()[2]
+            if entry is None: break # Closed
+
+            with self.i2c_lock:
+                key, args, future = entry
+                if self.i2c_keys.get(key) is entry: del self.i2c_keys[key]
+                if future is None: continue # Replaced by a later write
+
+            if not future.set_running_or_notify_cancel(): continue
+
+            try:
+                self._i2c_write(*args)
+                future.set_result(None)
+
+            except Exception as e: future.set_exception(e)
@@ -29,6 +29,7 @@ import os
 import sys
 import traceback
 import signal
+from concurrent.futures import Future
 
 from . import Cmd
 
@@ -53,7 +54,7 @@ class AVREmu(object):
         def _close(fd, withHandle):
             if fd is None: return
             try:
-                if withHandle: self.ctrl.ioloop.remove_handler(fd)
+                if withHandle: self.ctrl.serial_ioloop.remove_handler(fd)
             except: pass
             try:
                 os.close(fd)
@@ -99,6 +100,11 @@ class AVREmu(object):
                 os.close(stdoutFDs[0])
                 os.close(i2cFDs[1])
 
+                # Do not inherit the motion thread's real-time priority
+                try:
+                    os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+                except: pass
+
                 cmd = ['bbemu']
                 if self.ctrl.args.fast_emu: cmd.append('--fast')
 
@@ -119,7 +125,7 @@ class AVREmu(object):
             self.avrIn  = stdoutFDs[0]
             self.i2cOut = i2cFDs[1]
 
-            ioloop = self.ctrl.ioloop
+            ioloop = self.ctrl.serial_ioloop
             ioloop.add_handler(self.avrOut, self._avr_write_handler,
                                ioloop.WRITE | ioloop.ERROR)
             ioloop.add_handler(self.avrIn, self._avr_read_handler,
@@ -144,8 +150,8 @@ class AVREmu(object):
     def enable_write(self, enable):
         if self.avrOut is None: return
 
-        flags = self.ctrl.ioloop.WRITE if enable else 0
-        self.ctrl.ioloop.update_handler(self.avrOut, flags)
+        flags = self.ctrl.serial_ioloop.WRITE if enable else 0
+        self.ctrl.serial_ioloop.update_handler(self.avrOut, flags)
         self.write_enabled = enable
 
 
@@ -164,7 +170,7 @@ class AVREmu(object):
     def _avr_write_handler(self, fd, events):
         if self.avrOut is None: return
 
-        if events & self.ctrl.ioloop.ERROR:
+        if events & self.ctrl.serial_ioloop.ERROR:
             self._start()
             return
 
@@ -182,7 +188,7 @@ class AVREmu(object):
     def _avr_read_handler(self, fd, events):
         if self.avrIn is None: return
 
-        if events & self.ctrl.ioloop.ERROR:
+        if events & self.ctrl.serial_ioloop.ERROR:
             self._start()
             return
 
@@ -195,7 +201,11 @@ class AVREmu(object):
                         (data, traceback.format_exc()))
 
 
-    def i2c_command(self, cmd, byte = None, word = None, block = None):
+    def i2c_command(self, cmd, byte = None, word = None, block = None,
+                    key = None):
+        future = Future()
+        future.set_result(None) # Pipe writes do not block
+
         if byte is not None: data = chr(byte)
         elif word is not None: data = word
         elif block is not None: data = block
@@ -206,3 +216,5 @@ class AVREmu(object):
                 os.write(self.i2cOut, bytes(cmd + data + '\n', 'utf-8'))
 
         except BrokenPipeError: pass
+
+        return future
@@ -0,0 +1,263 @@
+################################################################################
+#                                                                              #
+#                 This file is part of the Buildbotics firmware.               #
+#                                                                              #
+#        Copyright (c) 2015 - 2021, Buildbotics LLC, All rights reserved.      #
+#                                                                              #
+#         This Source describes Open Hardware and is licensed under the        #
+#                                 CERN-OHL-S v2.                               #
+#                                                                              #
+#         You may redistribute and modify this Source and make products        #
+#    using it under the terms of the CERN-OHL-S v2 (https:/cern.ch/cern-ohl).  #
+#           This Source is distributed WITHOUT ANY EXPRESS OR IMPLIED          #
+#    WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS  #
+#     FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-S v2 for applicable    #
+#                                  conditions.                                 #
+#                                                                              #
+#                Source location: https://github.com/buildbotics               #
+#                                                                              #
+#      As per CERN-OHL-S v2 section 4, should You produce hardware based on    #
+#    these sources, You must maintain the Source Location clearly visible on   #
+#    the external case of the CNC Controller or other product you make using   #
+#                                  this Source.                                #
+#                                                                              #
+#                For more information, email info@buildbotics.com              #
+#                                                                              #
+################################################################################
+
+
+import json
+import struct
+import threading
+import time
+
+from . import Cmd
+
+__all__ = ['Capture', 'read_capture']
+
+
+# Capture file format:
+#   [magic] followed by records of [kind][f64 monotonic time][u32 length][data]
+MAGIC   = b'BBCAP\x01'
+OUT     = b'<' # Bytes written to the AVR
+IN      = b'>' # Bytes read from the AVR
+I2C     = b'i' # I2C command, as JSON [cmd, byte, word, block]
+
+_record = struct.Struct('<cdI')
+
+
+class Capture(object):
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.lock = threading.Lock() # Records may come from the motion thread
+        self.last_flush = time.monotonic()
+
+
+    def close(self):
+        with self.lock:
+            if self.f is not None: self.f.close()
+            self.f = None
+
+
+    def record(self, kind, data):
+        with self.lock:
+            if self.f is None: return
+
+            t = time.monotonic()
+            self.f.write(_record.pack(kind, t, len(data)))
+            self.f.write(data)
+
+            # Keep the file useful if the process is killed
+            if self.last_flush + 1 < t:
+                self.f.flush()
+                self.last_flush = t
+
+
+    def record_i2c(self, cmd, byte, word, block):
+        self.record(I2C, json.dumps([cmd, byte, word, block]).encode())
+
+
+def read_capture(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC: raise Exception('Not a capture file')
+
+        while True:
+            hdr = f.read(_record.size)
+            if len(hdr) < _record.size: break
+
+            kind, t, length = _record.unpack(hdr)
+            data = f.read(length)
+            if len(data) < length: break # Truncated
+
+            yield kind, t, data
+
+
+def split_commands(buf):
+    # Split outbound bytes into complete text commands and binary frames
+    i = 0
+
+    while i < len(buf):
+        if buf[i:i + 1] == Cmd.FRAME:
+            if len(buf) < i + 2: break
+            end = i + buf[i + 1] + 4
+            if len(buf) < end: break
+
+        else:
+            end = buf.find(b'\n', i) + 1
+            if not end: break
+
+        yield bytes(buf[i:end])
+        i = end
+
+    del buf[:i]
+
+
+def decode(path):
+    out = bytearray()
+    start = None
+
+    for kind, t, data in read_capture(path):
+        if start is None: start = t
+        t -= start
+
+        if kind == OUT:
+            out += data
+            for cmd in split_commands(out):
+                try:
+                    for msg in Cmd.decode(cmd):
+                        if msg: print('%.6f < %s' % (t, json.dumps(msg)))
+                        else: print('%.6f < %s' % (t, cmd.decode().strip()))
+
+                except Exception as e:
+                    print('%.6f < %r: %s' % (t, bytes(cmd), e))
+
+        elif kind == IN:
+            for line in data.decode('utf-8', 'replace').splitlines():
+                if line.strip(): print('%.6f > %s' % (t, line.strip()))
+
+        elif kind == I2C: print('%.6f I2C %s' % (t, data.decode()))
+
+
+def bench(path, repeat):
+    from .Comm import Comm, parse_line
+
+    class Reader(object):
+        def __init__(self):
+            self.in_buf = bytearray()
+            self.capture = None
+            self.lines = 0
+
+        def _process_line(self, line):
+            parse_line(line)
+            self.lines += 1
+
+    records = list(read_capture(path))
+    inbound = [data for kind, t, data in records if kind == IN]
+
+    # Inbound framing and parsing through Comm._read()
+    reader = Reader()
+    start = time.perf_counter()
+    for i in range(repeat):
+        for data in inbound: Comm._read(reader, data)
+    delta = time.perf_counter() - start
+
+    print('read: %d lines in %.3fs, %.1f us/line' % (
+        reader.lines, delta, 1e6 * delta / max(1, reader.lines)))
+
+    # Outbound command decoding
+    out = bytearray()
+    for kind, t, data in records:
+        if kind == OUT: out += data
+    cmds = list(split_commands(out))
+
+    errors = 0
+    start = time.perf_counter()
+    for i in range(repeat):
+        for cmd in cmds:
+            try:
+                for msg in Cmd.decode(cmd): pass
+            except Exception: errors += 1
+    delta = time.perf_counter() - start
+
+    count = repeat * len(cmds)
+    print('decode: %d commands in %.3fs, %.1f us/command, %d errors' % (
+        count, delta, 1e6 * delta / max(1, count), errors))
+
+
+def replay(path, speed, fast):
+    # Send the captured commands to bbemu with the captured timing
+    import types
+    import tornado.ioloop
+    from .IOLoop import IOLoop
+    from .Log import Log
+    from .AVREmu import AVREmu
+
+    args = types.SimpleNamespace(verbose = False, log_budget = [],
+                                 fast_emu = fast)
+    ioloop = IOLoop(tornado.ioloop.IOLoop.current())
+    ctrl = types.SimpleNamespace(args = args, ioloop = ioloop,
+                                 serial_ioloop = ioloop,
+                                 log = Log(args, ioloop, None))
+
+    out = bytearray()
+    records = [r for r in read_capture(path) if r[0] in (OUT, I2C)]
+    if not len(records): return
+    first = records[0][1]
+
+    def read_cb(data):
+        for line in data.decode('utf-8', 'replace').splitlines():
+            if line.strip(): print('> ' + line.strip())
+
+    def write_cb(write):
+        if len(out):
+            count = write(out)
+            if count: del out[:count]
+
+        if not len(out): avr.enable_write(False)
+
+    def send(kind, data):
+        if kind == I2C: avr.i2c_command(*json.loads(data.decode()))
+        else:
+            out.extend(data)
+            avr.enable_write(True)
+
+    def stop():
+        avr.close()
+        ctrl.ioloop.ioloop.stop()
+
+    avr = AVREmu(ctrl)
+    avr.set_handlers(read_cb, write_cb)
+
+    for kind, t, data in records:
+        ctrl.ioloop.call_later((t - first) / speed, send, kind, data)
+
+    ctrl.ioloop.call_later((records[-1][1] - first) / speed + 2, stop)
+    ctrl.ioloop.ioloop.start()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Serial capture tool')
+    sub = parser.add_subparsers(dest = 'command')
+    sub.required = True
+
+    p = sub.add_parser('decode', help = 'Print a capture file')
+    p.add_argument('path')
+
+    p = sub.add_parser('bench', help = 'Benchmark parsing a capture file')
+    p.add_argument('path')
+    p.add_argument('--repeat', default = 10, type = int)
+
+    p = sub.add_parser('replay', help = 'Replay a capture file into bbemu')
+    p.add_argument('path')
+    p.add_argument('--speed', default = 1, type = float,
+                   help = 'Replay speed multiplier')
+    p.add_argument('--fast-emu', action = 'store_true')
+
+    args = parser.parse_args()
+
+    if args.command == 'decode': decode(args.path)
+    if args.command == 'bench': bench(args.path, args.repeat)
+    if args.command == 'replay': replay(args.path, args.speed, args.fast_emu)
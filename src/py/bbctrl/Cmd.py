@@ -27,6 +27,11 @@
 #                                                                              #
 ################################################################################
 
+import struct
+import base64
+import binascii
+import operator
+
 
 # Keep this in sync with AVR code command.def
 SET          = '$'
@@ -54,34 +59,88 @@ FLUSH        = 'F'
 DUMP         = 'D'
 HELP         = 'h'
 
+# Binary frame start, keep this in sync with AVR code usart.h
+FRAME = b'\x01'
+
 SEEK_ACTIVE = 1 << 0
 SEEK_ERROR  = 1 << 1
 
 
-def encode_float(x):
-    import struct
-    import base64
+AXES = 'xyzabc'
+
+_float = struct.Struct('<f')
+_padded_structs = {}
+_layouts = {}
+_axes = tuple(zip(AXES, AXES.upper()))
+_frame_head = struct.Struct('<BH')
+_frame_crc = struct.Struct('<H')
+_sync_speed_frame = struct.Struct('<Bff')
+
 
-    return base64.b64encode(struct.pack('<f', x))[:-2].decode('utf-8')
+def encode_float(x):
+    return binascii.b2a_base64(_float.pack(x), newline = False)[:6].decode()
 
 
 def decode_float(s):
-    import struct
-    import base64
+    return _float.unpack(base64.b64decode(s + '=='))[0]
+
+
+def _padded_struct(count):
+    s = _padded_structs.get(count)
+
+    if s is None:
+        # Pad each float to 6 bytes so that base64 encodes every value to its
+        # own 8 char group, the first 6 chars of which match encode_float()
+        s = _padded_structs[count] = struct.Struct('<' + 'f2x' * count)
+
+    return s
+
+
+def _field_layout(tags):
+    layout = _layouts.get(tags)
+
+    if layout is None:
+        # Format string and slices selecting the first 6 chars of each value
+        fmt = ''.join(tag.replace('%', '%%') + '%s' for tag in tags)
+        slices = [slice(i, i + 6) for i in range(0, 8 * len(tags), 8)]
+
+        # itemgetter() only returns a tuple when given more than one item
+        if len(slices) == 1:
+            fmt += '%s'
+            slices.append(slice(0, 0))
+
+        layout = _layouts[tags] = (fmt, operator.itemgetter(*slices))
+
+    return layout
+
+
+def _encode_values(values):
+    data = _padded_struct(len(values)).pack(*values)
+    return binascii.b2a_base64(data, newline = False).decode()
+
+
+def _encode_fields(tags, values):
+    fmt, getter = _field_layout(tuple(tags))
+    return fmt % getter(_encode_values(values))
 
-    return struct.unpack('<f', base64.b64decode(s + '=='))[0]
+
+def _axes_fields(axes, tags, values):
+    for axis, upper in _axes:
+        if axis in axes: value = axes[axis]
+        elif upper in axes: value = axes[upper]
+        else: continue
+
+        tags.append(axis)
+        values.append(value)
 
 
 def encode_axes(axes):
-    data = ''
-    for axis in 'xyzabc':
-        if axis in axes:
-            data += axis + encode_float(axes[axis])
+    tags, values = [], []
+    _axes_fields(axes, tags, values)
+    return _encode_fields(tags, values) if len(values) else ''
 
-        elif axis.upper() in axes:
-            data += axis + encode_float(axes[axis.upper()])
 
-    return data
+def get(name): return SET + name
 
 
 def set_sync(name, value):
@@ -103,26 +162,113 @@ def modbus_write(addr, value): return MODBUS_WRITE + '%d=%d' % (addr, value)
 def set_axis(axis, position): return SET_AXIS + axis + encode_float(position)
 
 
-def line(target, exitVel, maxAccel, maxJerk, times, speeds):
-    cmd = LINE
+_time_tags = tuple(str(i) for i in range(7))
+_speed_tags = ('\n' + SYNC_SPEED, '')
+
 
-    cmd += encode_float(exitVel)
-    cmd += encode_float(maxAccel)
-    cmd += encode_float(maxJerk)
-    cmd += encode_axes(target)
+def _line_fields(target, exitVel, maxAccel, maxJerk, times, speeds, tags,
+                 values):
+    tags += (LINE, '', '')
+    values += (exitVel, maxAccel, maxJerk)
+
+    _axes_fields(target, tags, values)
 
     # S-Curve time parameters
     for i in range(7):
         if times[i]:
-            cmd += str(i) + encode_float(times[i] / 60000) # to mins
+            tags.append(_time_tags[i])
+            values.append(times[i] / 60000) # to mins
 
     # Speeds
     for dist, speed in speeds:
-        cmd += '\n' + sync_speed(dist, speed)
+        tags += _speed_tags
+        values += (dist, speed)
+
+
+def line(target, exitVel, maxAccel, maxJerk, times, speeds):
+    tags, values = [], []
+    _line_fields(target, exitVel, maxAccel, maxJerk, times, speeds, tags,
+                 values)
+    return _encode_fields(tags, values)
+
+
+def lines(blocks):
+    # Encode a batch of planner line blocks with a single pack and encode
+    layouts, values = [], []
+
+    for block in blocks:
+        tags = []
+        _line_fields(block['target'], block['exit-vel'], block['max-accel'],
+                     block['max-jerk'], block['times'],
+                     block.get('speeds', []), tags, values)
+        layouts.append((len(tags), _field_layout(tuple(tags))))
+
+    enc = _encode_values(values) if len(values) else ''
+    cmds = []
+    offset = 0
+
+    for count, (fmt, getter) in layouts:
+        end = offset + 8 * count
+        cmds.append(fmt % getter(enc[offset:end]))
+        offset = end
+
+    return cmds
+
+
+def frame(payload):
+    # [start][length][payload][crc16]
+    data = bytes((len(payload),)) + payload
+    return FRAME + data + _frame_crc.pack(binascii.crc_hqx(data, 0xffff))
+
+
+def set_sync_frame(name, value):
+    if isinstance(value, float): value = b'f' + _float.pack(value)
+    else: value = b'i' + struct.pack('<i', value)
+
+    return frame(SET_SYNC.encode() + value + name.encode())
+
+
+def line_frame(target, exitVel, maxAccel, maxJerk, times, speeds):
+    flags = 0
+    values = [exitVel, maxAccel, maxJerk]
+
+    for i, (axis, upper) in enumerate(_axes):
+        if axis in target: value = target[axis]
+        elif upper in target: value = target[upper]
+        else: continue
+
+        flags |= 1 << i
+        values.append(value)
+
+    # S-Curve time parameters
+    for i in range(7):
+        if times[i]:
+            flags |= 1 << (len(AXES) + i)
+            values.append(times[i] / 60000) # to mins
+
+    cmd = frame(_frame_head.pack(ord(LINE), flags) +
+                struct.pack('<%df' % len(values), *values))
+
+    # Speeds
+    for dist, speed in speeds: cmd += sync_speed_frame(dist, speed)
 
     return cmd
 
 
+def sync_speed_frame(dist, speed):
+    return frame(_sync_speed_frame.pack(ord(SYNC_SPEED), dist, speed))
+
+
+def join(*cmds):
+    # Text commands are newline terminated, binary frames are not
+    if not any(isinstance(cmd, bytes) for cmd in cmds):
+        return '\n'.join(cmds)
+
+    return b''.join(
+        cmd if isinstance(cmd, bytes) else (cmd + '\n').encode()
+        for cmd in cmds if len(cmd))
+
+
 def speed(value): return SPEED + encode_float(value)
 
 
@@ -205,7 +351,11 @@ def decode_command(cmd):
 
     data = {}
 
-    if cmd[0] == SET or cmd[0] == SET_SYNC:
+    if cmd[0] == SET and cmd.find('=') == -1:
+        data['type'] = 'get'
+        data['name'] = cmd[1:]
+
+    elif cmd[0] == SET or cmd[0] == SET_SYNC:
         data['type'] = 'set'
         if cmd[0] == SET_SYNC: data['sync'] = True
 
@@ -221,8 +371,9 @@ def decode_command(cmd):
 
     elif cmd[0] == JOG:
         data['type'] = 'jog'
+        data['id'] = int(cmd[1:5], 16)
 
-        cmd = cmd[1:]
+        cmd = cmd[5:]
         while len(cmd):
             name = cmd[0]
             value = decode_float(cmd[1:7])
@@ -275,7 +426,63 @@ def decode_command(cmd):
     return data
 
 
+def decode_frame(payload):
+    code = chr(payload[0])
+    data = {}
+
+    if code == LINE:
+        flags = _frame_head.unpack_from(payload)[1]
+        values = struct.unpack_from('<%df' % ((len(payload) - 3) // 4),
+                                    payload, 3)
+
+        data['type'] = 'line'
+        data['exit-vel'], data['max-accel'], data['max-jerk'] = values[:3]
+        data['target'] = {}
+        data['times'] = [0] * 7
+        values = list(values[3:])
+
+        for i in range(len(AXES)):
+            if flags & (1 << i): data['target'][AXES[i]] = values.pop(0)
+
+        for i in range(7):
+            if flags & (1 << (len(AXES) + i)): data['times'][i] = values.pop(0)
+
+    elif code == SYNC_SPEED:
+        data['type'] = 'speed'
+        data['offset'], data['speed'] = _sync_speed_frame.unpack(payload)[1:]
+
+    elif code == SET_SYNC:
+        data['type'] = 'set'
+        data['sync'] = True
+        data['name'] = payload[6:].decode()
+        kind = '<f' if payload[1:2] == b'f' else '<i'
+        data['value'] = struct.unpack_from(kind, payload, 2)[0]
+
+    return data
+
+
+def decode_frames(cmd):
+    # Split a byte stream of binary frames and text lines
+    i = 0
+
+    while i < len(cmd):
+        if cmd[i:i + 1] == FRAME:
+            length = cmd[i + 1]
+            yield decode_frame(cmd[i + 2:i + 2 + length])
+            i += length + 4
+
+        else:
+            end = cmd.find(b'\n', i)
+            if end == -1: end = len(cmd)
+            yield decode_command(cmd[i:end].decode().strip())
+            i = end + 1
+
+
 def decode(cmd):
+    if isinstance(cmd, bytes):
+        for data in decode_frames(cmd): yield data
+        return
+
     for line in cmd.split('\n'):
         yield decode_command(line.strip())
 
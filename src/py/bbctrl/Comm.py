@@ -33,6 +33,8 @@ from collections import deque
 from abc import *
 
 from . import Cmd
+from .Capture import Capture, IN, OUT
+from .Log import Lazy
 
 __all__ = ['Comm']
 
@@ -68,18 +70,47 @@ def driver_flags_to_string(flags):
     return ', '.join(_driver_flags_to_string(flags))
 
 
+# Delay before asking a full AVR queue for more credits
+CREDIT_POLL = 0.05
+
+
+# Raw JSON object scanner, skips the json.loads() wrapper overhead
+_scan_json = json.JSONDecoder().scan_once
+
+
+def parse_line(line):
+    # Fast path for AVR reports such as {"xp":1.5,"v":0,"xx":"READY"}
+    if line[:1] == '{':
+        try:
+            msg, end = _scan_json(line, 0)
+            if end == len(line): return msg
+        except (StopIteration, ValueError): pass
+
+    # Fall back to the full parser, which also reports errors
+    return json.loads(line)
+
+
 class Comm(ABC):
     def __init__(self, ctrl, avr):
         self.ctrl = ctrl
         self.avr = avr
         self.log = self.ctrl.log.get('Comm')
-        self.queue = deque()
-        self.in_buf = ''
-        self.command = None
+        self.motion = ctrl.motion # Serial I/O thread, if enabled
+        self.queue = deque()  # Entries are [key, cmd], cmd is None if replaced
+        self.urgent = deque() # Ahead of all other commands
+        self.keys = {}        # Latest queued entry by coalescing key
+        self.in_buf = bytearray()
+        self.out_buf = bytearray()
+        self.batch_size = ctrl.args.serial_batch
+        self.frames = set() # Commands the AVR accepts as binary frames
+        self._reset_credits(None)
         self.last_motor_flags = [0] * 4
 
-        avr.set_handlers(self._read, self._write)
-        self._poll_cb(False)
+        self.capture = None
+        if ctrl.args.serial_capture:
+            self.capture = Capture(ctrl.args.serial_capture)
+
+        self._on_motion(avr.set_handlers, self._read, self._write)
 
         # Let simulations proceed after timeout
         ctrl.ioloop.call_later(10, self.ctrl.ready)
@@ -90,16 +121,41 @@ class Comm(ABC):
     def comm_error(self): pass
 
 
-    def is_active(self): return len(self.queue) or self.command is not None
+    def close(self):
+        if self.capture is not None: self.capture.close()
 
 
-    def i2c_command(self, cmd, byte = None, word = None, block = None):
+    def is_active(self):
+        return len(self.urgent) or len(self.queue) or len(self.out_buf)
+
+
+    def _on_motion(self, cb, *args):
+        # Serial I/O, command writing and credits belong to the motion thread
+        if self.motion is None: cb(*args)
+        else: self.motion.ioloop.add_callback(cb, *args)
+
+
+    def _on_main(self, cb, *args):
+        # Machine state and the planner belong to the main ioloop
+        if self.motion is None: cb(*args)
+        else: self.ctrl.ioloop.add_callback(cb, *args)
+
+
+    def i2c_command(self, cmd, byte = None, word = None, block = None,
+                    key = None):
+        # Returns a future, the write completes in the background
         self.log.info('I2C: %s b=%s w=%s d=%s' % (cmd, byte, word, block))
-        self.avr.i2c_command(cmd, byte, word, block)
+        if self.capture is not None:
+            self.capture.record_i2c(cmd, byte, word, block)
+        return self.avr.i2c_command(cmd, byte, word, block, key)
+
+
+    def i2c_block(self, block, key = None):
+        return self.i2c_command(block[0], block = block[1:], key = key)
 
 
-    def i2c_block(self, block): self.i2c_command(block[0], block = block[1:])
-    def i2c_set(self, name, value): self.i2c_block(Cmd.set(name, value))
+    def i2c_set(self, name, value):
+        return self.i2c_block(Cmd.set(name, value), '$' + name)
 
 
     def modbus_read(self, addr): self.i2c_block(Cmd.modbus_read(addr))
@@ -109,57 +165,147 @@ class Comm(ABC):
         self.i2c_block(Cmd.modbus_write(addr, value))
 
 
-    def flush(self): self.avr.enable_write(True)
+    def flush(self): self._on_motion(self.avr.enable_write, True)
 
 
     def _prep_command(self, cmd):
-        self.log.info('< ' + json.dumps(cmd).strip('"'))
+        if isinstance(cmd, bytes):
+            # Frames are only decoded if logged
+            self.log.info('< %s', Lazy(lambda: '\n'.join(
+                json.dumps(data) for data in Cmd.decode(cmd))))
+            return cmd
+
+        self.log.info('< %s', Lazy(lambda: json.dumps(cmd).strip('"')))
         return bytes(cmd.strip() + '\n', 'utf-8')
 
 
-    def resume(self): self.queue_command(Cmd.RESUME)
+    def resume(self): self.queue_command(Cmd.RESUME, urgent = True)
+
+
+    def queue_command(self, cmd, key = None, urgent = False):
+        if urgent: self.urgent.append(cmd)
+
+        else:
+            entry = [key, cmd]
+
+            if key is not None:
+                # Only the latest command with the same key is sent
+                old = self.keys.get(key)
+                if old is not None: old[1] = None
+                self.keys[key] = entry
 
+            self.queue.append(entry)
 
-    def queue_command(self, cmd):
-        self.queue.append(cmd)
         self.flush()
 
 
-    def _poll_cb(self, now = True):
-        # Checks periodically for new commands from planner via comm_next()
-        if now: self.flush()
-        self.ctrl.ioloop.call_later(1, self._poll_cb)
+    def _next_queued(self):
+        if len(self.urgent): return self.urgent.popleft()
 
+        while len(self.queue):
+            key, cmd = entry = self.queue.popleft()
 
-    def _write(self, write_cb):
-        # Finish writing current command
-        if self.command is not None:
-            try:
-                count = write_cb(self.command)
+            if key is not None and self.keys.get(key) is entry:
+                del self.keys[key]
 
-            except Exception as e:
-                self.command = None
-                raise e
+            if cmd is not None: return cmd
 
-            self.command = self.command[count:]
-            if len(self.command): return # There's more
-            self.command = None
 
-        # Load next command from queue
-        if len(self.queue):
-            self.command = self._prep_command(self.queue.popleft())
+    def _reset_credits(self, credits):
+        # Credits count the planner commands the AVR has queue space for.
+        # None means the AVR does not report its free queue space.
+        self.credits = credits
+        self.credit_window = credits or 0
+        self.credit_sent = 0    # Planner commands sent since the last query
+        self.credit_query = False
+
+
+    def _update_credits(self, free):
+        if not self.credit_query: return # Not a response to our query
+        self.credit_query = False
+
+        # Commands sent after the query are not yet counted by the AVR
+        self.credits = free - self.credit_sent
+        self.credit_window = max(self.credit_window, free)
+
+        # Keep polling a full queue at a limited rate
+        if not self._credits_low(): self.flush()
+        else: self.ctrl.serial_ioloop.call_later(CREDIT_POLL, self.flush)
+
+
+    def _credits_low(self): return self.credits <= self.credit_window // 2
+
+
+    def _has_credit(self): return self.credits is not None and 0 < self.credits
 
-        # Load next command from callback
-        else:
-            cmd = self.comm_next() # pylint: disable=assignment-from-no-return
 
-            if cmd is None: self.avr.enable_write(False) # Stop writing
-            else: self.command = self._prep_command(cmd)
+    def _next_command(self):
+        # Queued commands take priority over planner commands
+        cmd = self._next_queued()
+        if cmd is not None: return cmd
+
+        if self.credits is None:
+            return self.comm_next() # pylint: disable=assignment-from-no-return
+
+        # Ask for more credits before they run out
+        if self._credits_low() and not self.credit_query:
+            self.credit_query = True
+            self.credit_sent = 0
+            return Cmd.get('qf')
+
+        if self.credits <= 0: return # Wait for credits
+
+        cmd = self.comm_next() # pylint: disable=assignment-from-no-return
+
+        if cmd is not None:
+            self.credits -= 1
+            self.credit_sent += 1
+
+        return cmd
+
+
+    def _fill(self):
+        # Always load at least one command, then up to the batch size or as
+        # many planner commands as the AVR has queue space for
+        while (not len(self.out_buf) or len(self.out_buf) < self.batch_size or
+               self._has_credit()):
+            cmd = self._next_command()
+            if cmd is None: break
+            self.out_buf += self._prep_command(cmd)
+
+
+    def _write(self, write_cb):
+        # Batch as many commands as fit into a single write
+        self._fill()
+
+        if not len(self.out_buf):
+            self.avr.enable_write(False) # Stop writing
+            return
+
+        try:
+            count = write_cb(self.out_buf)
+
+        except Exception as e:
+            self.out_buf.clear()
+            raise e
+
+        # Keep any unwritten data for the next write
+        if count:
+            if self.capture is not None:
+                self.capture.record(OUT, bytes(self.out_buf[:count]))
+            del self.out_buf[:count]
 
 
     def _update_vars(self, msg):
         try:
             self.ctrl.state.set_machine_vars(msg['variables'])
+
+            if not self.ctrl.args.disable_frames:
+                self.frames = set(msg.get('frames', []))
+
+            # Use credit flow control if the AVR reports its queue space
+            credits = 0 if 'qf' in msg['variables'] else None
+            self._on_motion(self._reset_credits, credits)
             self.ctrl.configure()
             self.queue_command(Cmd.DUMP) # Refresh all vars
 
@@ -214,34 +360,55 @@ class Comm(ABC):
         self._log_motor_flags(update)
 
 
-    def _read(self, data):
-        self.in_buf += data.decode('utf-8')
+    def _process_line(self, line):
+        self.log.info('> ' + line)
+
+        try:
+            msg = parse_line(line)
+
+        except Exception as e:
+            self.log.warning('%s, data: %s', e, line)
+            return
 
-        # Parse incoming serial data into lines
-        while True:
-            i = self.in_buf.find('\n')
-            if i == -1: break
-            line = self.in_buf[0:i].strip()
-            self.in_buf = self.in_buf[i + 1:]
+        # Credits are kept with the writer, on the motion thread if enabled
+        if 'qf' in msg:
+            self._update_credits(msg.pop('qf'))
+            if not len(msg): return
 
-            if line:
-                self.log.info('> ' + line)
+        self._on_main(self._dispatch, msg)
 
-                try:
-                    msg = json.loads(line)
 
-                except Exception as e:
-                    self.log.warning('%s, data: %s', e, line)
-                    continue
+    def _dispatch(self, msg):
+        if 'variables' in msg: self._update_vars(msg)
+        elif 'msg' in msg: self._log_msg(msg)
 
-                if 'variables' in msg: self._update_vars(msg)
-                elif 'msg' in msg: self._log_msg(msg)
+        elif 'firmware' in msg:
+            self.log.info('AVR firmware rebooted')
+            self.connect()
 
-                elif 'firmware' in msg:
-                    self.log.info('AVR firmware rebooted')
-                    self.connect()
+        else: self._update_state(msg)
 
-                else: self._update_state(msg)
+
+    def _read(self, data):
+        if self.capture is not None: self.capture.record(IN, data)
+
+        buf = self.in_buf
+        buf += data
+        start = 0
+
+        # Parse incoming serial data into lines without copying the buffer
+        try:
+            with memoryview(buf) as view:
+                while True:
+                    i = buf.find(b'\n', start)
+                    if i == -1: break
+                    line = str(view[start:i], 'utf-8', 'replace').strip()
+                    start = i + 1
+
+                    if line: self._process_line(line)
+
+        finally:
+            if start: del buf[:start] # Drop consumed data
 
 
     def estop(self):
@@ -262,9 +429,11 @@ class Comm(ABC):
 
 
     def connect(self):
+        self._on_motion(self._reset_credits, None)
+
         try:
             # Resume once current queue of GCode commands has flushed
-            self.queue_command(Cmd.RESUME)
+            self.queue_command(Cmd.RESUME, urgent = True)
             self.queue_command(Cmd.set('ct', 128))
             self.queue_command(Cmd.HELP) # Load AVR commands and variables
 
@@ -25,7 +25,7 @@
 #                                                                              #
 ################################################################################
 
-from collections import deque
+from array import array
 
 from . import util
 from .Log import *
@@ -35,50 +35,76 @@ __all__ = ['CommandQueue']
 
 class CommandQueue():
     def __init__(self, ctrl):
+        self.ctrl = ctrl
         self.log = ctrl.log.get('CmdQ')
         self.log.set_level(Log.WARNING)
+        self.clear()
 
-        self.lastEnqueueID = 0
-        self.releaseID = 0
-        self.q = deque()
+
+    def is_active(self): return 0 < self.depth
 
 
-    def is_active(self): return len(self.q)
+    def next_id(self):
+        # An ID after all enqueued and released IDs
+        id = self.releaseID
+        if util.id16_less(id, self.lastEnqueueID): id = self.lastEnqueueID
+        return id + 1 if id < 0xffff else 1
+
+
+    def _update_depth(self): self.ctrl.state.set('cmdq_depth', self.depth)
 
 
     def clear(self):
         self.lastEnqueueID = 0
         self.releaseID = 0
-        self.q.clear()
+        self.counts = array('I', [0]) * (1 << 16) # Entries by 16-bit ID
+        self.callbacks = {} # Only IDs with callbacks
+        self.depth = 0
+        self._update_depth()
+
+
+    def _call(self, cb, args, kwargs):
+        try:
+            cb(*args, **kwargs)
+        except Exception:
+            self.log.exception('During command queue callback')
 
 
     def enqueue(self, id, cb, *args, **kwargs):
-        self.log.info('add(#%d) releaseID=%d', id, self.releaseID)
         self.lastEnqueueID = id
-        self.q.append([id, cb, args, kwargs])
-        self._release()
 
+        # Already released
+        if not util.id16_less(self.releaseID, id):
+            if cb is not None: self._call(cb, args, kwargs)
+            return
 
-    def _release(self):
-        while len(self.q):
-            id, cb, args, kwargs = self.q[0]
+        self.counts[id] += 1
+        self.depth += 1
 
-            # Execute commands <= releaseID
-            if util.id16_less(self.releaseID, id): return
+        if cb is not None:
+            self.callbacks.setdefault(id, []).append((cb, args, kwargs))
 
-            self.log.info('releasing id=%d' % id)
-            self.q.popleft()
 
-            try:
-                if cb is not None: cb(*args, **kwargs)
-            except Exception:
-                self.log.exception('During command queue callback')
+    def release(self, id):
+        if not util.id16_less(self.releaseID, id):
+            if id: self.log.debug('id out of order %d <= %d', id,
+                                  self.releaseID)
+            self.releaseID = id
+            return
+
+        # Release the whole ID range (releaseID, id] in one pass
+        i = self.releaseID
+        self.releaseID = id
 
+        while self.depth and i != id:
+            i = (i + 1) & 0xffff
+            count = self.counts[i]
+            if not count: continue
 
+            self.counts[i] = 0
+            self.depth -= count
 
-    def release(self, id):
-        if id and not util.id16_less(self.releaseID, id):
-            self.log.debug('id out of order %d <= %d' % (id, self.releaseID))
-        self.releaseID = id
+            for cb, args, kwargs in self.callbacks.pop(i, ()):
+                self._call(cb, args, kwargs)
 
-        self._release()
+        self._update_depth()
@@ -33,13 +33,19 @@ from .Log import *
 from .Events import *
 from .State import *
 from .Config import *
+from .MotionThread import *
 from .AVREmu import *
 from .AVR import *
 from .I2C import *
 from .LCD import *
 from .Mach import *
 from .Preplanner import *
+from .ETA import *
+from .JobQueue import *
 from .FileSystem import *
+from .TPLCache import *
+from .HashCache import *
+from .Macros import *
 from .Jog import *
 from .Pwr import *
 from .MainLCDPage import *
@@ -71,6 +77,10 @@ class Ctrl(object):
 
         self.log.get('Ctrl').info('Starting %s' % self.id)
 
+        self.motion = MotionThread(self) if args.motion_thread else None
+        if self.motion is None: self.serial_ioloop = self.ioloop
+        else: self.serial_ioloop = self.motion.ioloop
+
         try:
             if args.demo: self.avr = AVREmu(self)
             else: self.avr = AVR(self)
@@ -80,6 +90,11 @@ class Ctrl(object):
             self.mach = Mach(self, self.avr)
             self.preplanner = Preplanner(self)
             self.fs = FileSystem(self)
+            self.tpl = TPLCache(self)
+            self.hashes = HashCache(self)
+            self.macros = Macros(self)
+            self.eta = ETA(self)
+            self.queue = JobQueue(self)
             if not args.demo: self.jog = Jog(self)
             self.pwr = Pwr(self)
 
@@ -119,6 +134,7 @@ class Ctrl(object):
         # Indirectly configures state via calls to config() and the AVR
         self.config.reload()
         self.state.init()
+        self.macros.load()
 
 
     def ready(self):
@@ -129,5 +145,7 @@ class Ctrl(object):
     def close(self):
         self.log.get('Ctrl').info('Closing %s' % self.id)
         self.ioloop.close()
+        if self.motion is not None: self.motion.close()
         self.avr.close()
+        self.mach.close()
         self.mach.planner.close()
@@ -0,0 +1,112 @@
+################################################################################
+#                                                                              #
+#                 This file is part of the Buildbotics firmware.               #
+#                                                                              #
+#        Copyright (c) 2015 - 2021, Buildbotics LLC, All rights reserved.      #
+#                                                                              #
+#         This Source describes Open Hardware and is licensed under the        #
+#                                 CERN-OHL-S v2.                               #
+#                                                                              #
+#         You may redistribute and modify this Source and make products        #
+#    using it under the terms of the CERN-OHL-S v2 (https:/cern.ch/cern-ohl).  #
+#           This Source is distributed WITHOUT ANY EXPRESS OR IMPLIED          #
+#    WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS  #
+#     FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-S v2 for applicable    #
+#                                  conditions.                                 #
+#                                                                              #
+#                Source location: https://github.com/buildbotics               #
+#                                                                              #
+#      As per CERN-OHL-S v2 section 4, should You produce hardware based on    #
+#    these sources, You must maintain the Source Location clearly visible on   #
+#    the external case of the CNC Controller or other product you make using   #
+#                                  this Source.                                #
+#                                                                              #
+#                For more information, email info@buildbotics.com              #
+#                                                                              #
+################################################################################
+
+
+import time
+import bisect
+
+__all__ = ['ETA']
+
+
+class ETA(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+        self.log = ctrl.log.get('ETA')
+        self.period = ctrl.args.eta_period
+        self.path = None
+        self._clear()
+
+        if self.period: ctrl.ioloop.call_later(self.period, self._update)
+
+
+    def _clear(self):
+        self.lines = [] # Lines where the plan time table changes
+        self.times = [] # Plan time at the start of each line
+        self.total = 0
+
+
+    def _load(self, path):
+        self.path = path
+        self._clear()
+
+        if not path or not self.ctrl.fs.isfile(path): return
+
+        preplanner = self.ctrl.preplanner
+        plan = preplanner.get_plan(path, preplanner.ACTIVE)
+        self.ctrl.ioloop.add_future(plan, lambda f: self._set_table(path, f))
+
+
+    def _set_table(self, path, plan):
+        if path != self.path: return # Program changed
+
+        try:
+            meta = plan.result()[0]
+            table = meta.get('line_times')
+
+            if table is not None:
+                self.lines, self.times = table['line'], table['time']
+                self.total = meta['time']
+
+        except Exception as e:
+            self.log.info('No plan time table for %s: %s' % (path, e))
+
+
+    def get_elapsed(self, line):
+        i = bisect.bisect_right(self.lines, line) - 1
+        return self.times[i] if 0 <= i else 0
+
+
+    def _publish(self):
+        state = self.ctrl.state
+
+        if not self.total or state.get('xx', '') not in (
+                'RUNNING', 'STOPPING', 'HOLDING'):
+            state.update(dict(eta = None, remaining = None, percent = None))
+            return
+
+        elapsed = self.get_elapsed(state.get('line', 0))
+        remaining = max(0, self.total - elapsed)
+
+        # Feed override scales the time left
+        override = state.get('fo', 1)
+        if 0 < override: remaining /= override
+
+        state.update(dict(
+            eta       = round(time.time() + remaining),
+            remaining = round(remaining),
+            percent   = round(100 * elapsed / self.total, 1)))
+
+
+    def _update(self):
+        try:
+            path = self.ctrl.state.get('active_program', '')
+            if path != self.path: self._load(path)
+            self._publish()
+
+        except Exception: self.log.exception()
+
+        self.ctrl.ioloop.call_later(self.period, self._update)
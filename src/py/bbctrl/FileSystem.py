@@ -125,8 +125,10 @@ class FileSystem:
       f.write(data)
 
       self.log.info('Wrote ' + path)
-      self.ctrl.events.emit('invalidate', path)
-      os.sync()
+
+    self.ctrl.hashes.add(realpath, data)
+    self.ctrl.events.emit('invalidate', path)
+    os.sync()
 
 
   def usb_update(self):
@@ -0,0 +1,141 @@
+################################################################################
+#                                                                              #
+#                 This file is part of the Buildbotics firmware.               #
+#                                                                              #
+#        Copyright (c) 2015 - 2021, Buildbotics LLC, All rights reserved.      #
+#                                                                              #
+#         This Source describes Open Hardware and is licensed under the        #
+#                                 CERN-OHL-S v2.                               #
+#                                                                              #
+#         You may redistribute and modify this Source and make products        #
+#    using it under the terms of the CERN-OHL-S v2 (https:/cern.ch/cern-ohl).  #
+#           This Source is distributed WITHOUT ANY EXPRESS OR IMPLIED          #
+#    WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS  #
+#     FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-S v2 for applicable    #
+#                                  conditions.                                 #
+#                                                                              #
+#                Source location: https://github.com/buildbotics               #
+#                                                                              #
+#      As per CERN-OHL-S v2 section 4, should You produce hardware based on    #
+#    these sources, You must maintain the Source Location clearly visible on   #
+#    the external case of the CNC Controller or other product you make using   #
+#                                  this Source.                                #
+#                                                                              #
+#                For more information, email info@buildbotics.com              #
+#                                                                              #
+################################################################################
+
+
+import os
+import json
+import hashlib
+from tornado import gen
+from tornado.concurrent import run_on_executor
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['HashCache']
+
+
+def stat_key(path):
+    s = os.stat(path)
+    return '%d:%d:%d:%d' % (s.st_dev, s.st_ino, s.st_size, s.st_mtime_ns)
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(1024 * 1024)
+            if not buf: break
+            h.update(buf)
+
+    return h.hexdigest()
+
+
+class HashCache(object):
+    executor = ThreadPoolExecutor(max_workers = 1)
+
+
+    def __init__(self, ctrl, max_hashes = 1000):
+        self.ctrl = ctrl
+        self.log = ctrl.log.get('HashCache')
+        self.path = ctrl.get_path(filename = 'hashes.json')
+        self.max_hashes = max_hashes
+        self.hashes = {} # SHA-256 by file device, inode, size and mtime
+        self.pending = {} # Upload hash futures by the same key
+        self.save_timeout = None
+
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f: self.hashes = json.load(f)
+
+        except Exception: self.log.exception('Failed to load file hashes')
+
+
+    def _save(self):
+        self.save_timeout = None
+
+        try:
+            with open(self.path + '.tmp', 'w') as f: json.dump(self.hashes, f)
+            os.replace(self.path + '.tmp', self.path)
+
+        except Exception: self.log.exception('Failed to save file hashes')
+
+
+    def _add(self, key, digest):
+        if key is None: return # File changed while hashing
+
+        self.hashes.pop(key, None)
+        self.hashes[key] = digest
+
+        # Drop the oldest hashes
+        while self.max_hashes < len(self.hashes):
+            del self.hashes[next(iter(self.hashes))]
+
+        if self.save_timeout is None:
+            self.save_timeout = self.ctrl.ioloop.call_later(5, self._save)
+
+
+    @run_on_executor
+    def _hash_file(self, path):
+        key = stat_key(path)
+        digest = hash_file(path)
+        return (key if key == stat_key(path) else None), digest
+
+
+    @run_on_executor
+    def _hash_data(self, key, data):
+        return key, hashlib.sha256(data).hexdigest()
+
+
+    def lookup(self, path):
+        # Cached hash of the file as it is now, None if not hashed yet
+        return self.hashes.get(stat_key(path))
+
+
+    @gen.coroutine
+    def get(self, path):
+        key = stat_key(path)
+        if key in self.hashes: return self.hashes[key]
+
+        # Wait for an upload that is already being hashed
+        if key in self.pending:
+            key, digest = yield self.pending[key]
+            return digest
+
+        key, digest = yield self._hash_file(path)
+        self._add(key, digest)
+        return digest
+
+
+    def add(self, path, data):
+        # Hash uploaded data off the ioloop, before it is first planned
+        key = stat_key(path)
+        future = self.pending[key] = self._hash_data(key, data)
+        self.ctrl.ioloop.add_future(future, lambda f: self._added(key, f))
+
+
+    def _added(self, key, future):
+        self.pending.pop(key, None)
+        self._add(*future.result())
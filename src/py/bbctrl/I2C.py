@@ -26,6 +26,7 @@
 ################################################################################
 
 import errno
+import threading
 
 try:
     try:
@@ -43,6 +44,7 @@ class I2C(object):
         self.port = port
         self.i2c_bus = None
         self.disabled = disabled or smbus is None
+        self.lock = threading.Lock() # AVR commands are written from a worker
 
 
     def connect(self):
@@ -58,6 +60,10 @@ class I2C(object):
 
 
     def read_word(self, addr, reg, pec = False):
+        with self.lock: return self._read_word(addr, reg, pec)
+
+
+    def _read_word(self, addr, reg, pec):
         self.connect()
         if self.disabled: return
 
@@ -73,6 +79,10 @@ class I2C(object):
 
     def write(self, addr, cmd, byte = None, word = None, block = None,
               pec = False):
+        with self.lock: self._write(addr, cmd, byte, word, block, pec)
+
+
+    def _write(self, addr, cmd, byte, word, block, pec):
         self.connect()
         if self.disabled: return
 
@@ -0,0 +1,297 @@
+################################################################################
+#                                                                              #
+#                 This file is part of the Buildbotics firmware.               #
+#                                                                              #
+#        Copyright (c) 2015 - 2021, Buildbotics LLC, All rights reserved.      #
+#                                                                              #
+#         This Source describes Open Hardware and is licensed under the        #
+#                                 CERN-OHL-S v2.                               #
+#                                                                              #
+#         You may redistribute and modify this Source and make products        #
+#    using it under the terms of the CERN-OHL-S v2 (https:/cern.ch/cern-ohl).  #
+#           This Source is distributed WITHOUT ANY EXPRESS OR IMPLIED          #
+#    WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS  #
+#     FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-S v2 for applicable    #
+#                                  conditions.                                 #
+#                                                                              #
+#                Source location: https://github.com/buildbotics               #
+#                                                                              #
+#      As per CERN-OHL-S v2 section 4, should You produce hardware based on    #
+#    these sources, You must maintain the Source Location clearly visible on   #
+#    the external case of the CNC Controller or other product you make using   #
+#                                  this Source.                                #
+#                                                                              #
+#                For more information, email info@buildbotics.com              #
+#                                                                              #
+################################################################################
+
+
+import os
+import json
+
+__all__ = ['JobQueue']
+
+
+class JobQueue(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+        self.log = ctrl.log.get('JobQueue')
+        self.path = ctrl.get_path(filename = 'queue.json')
+
+        self.jobs = []
+        self.next_id = 1
+        self.active = False # Start jobs one after another
+        self.starting = None # Job to start once it is checked
+        self.checking = None # Plan future of the job being checked
+
+        self._load()
+
+        ctrl.events.on('program-end', self._end)
+        ctrl.events.on('invalidate', self._invalidate)
+        ctrl.events.on('invalidate-all', lambda: self._invalidate(None))
+
+
+    def _load(self):
+        try:
+            if not os.path.exists(self.path): return
+
+            with open(self.path, 'r') as f: journal = json.load(f)
+            self.jobs = journal['jobs']
+            self.next_id = journal['next_id']
+
+            for job in self.jobs:
+                # Never resume motion after a restart
+                if job['status'] == 'running':
+                    job['status'] = 'stopped'
+                    job['error'] = 'Interrupted'
+
+                # Files may have changed, check them again
+                elif job['status'] in ('checking', 'ready', 'invalid'):
+                    job['status'] = 'queued'
+
+            self.log.info('Loaded %d queued jobs' % len(self.jobs))
+
+        except Exception:
+            self.log.exception('Failed to load job queue')
+            self.jobs = []
+
+        self._update()
+
+
+    def _save(self):
+        journal = dict(next_id = self.next_id, jobs = self.jobs)
+
+        try:
+            with open(self.path + '.tmp', 'w') as f: json.dump(journal, f)
+            os.replace(self.path + '.tmp', self.path)
+
+        except Exception: self.log.exception('Failed to save job queue')
+
+
+    def _update(self):
+        self._save()
+        self.ctrl.state.set('queue_active', self.active)
+        self.ctrl.state.set('queue_length', len(self._pending()))
+        self._check_next()
+
+
+    def _pending(self):
+        return [job for job in self.jobs
+                if job['status'] not in ('running', 'done', 'stopped')]
+
+
+    def _find(self, id):
+        for job in self.jobs:
+            if job['id'] == id: return job
+
+
+    def _is_queued(self, job):
+        return any(j is job for j in self.jobs)
+
+
+    def _is_busy(self):
+        state = self.ctrl.state
+        return (state.get('cycle', 'idle') != 'idle' or
+                state.get('xx', '') == 'ESTOPPED')
+
+
+    def _hold_busy(self):
+        self.log.warning('Queue held, machine is busy')
+        self.hold()
+
+
+    def get(self): return dict(active = self.active, jobs = self.jobs)
+
+
+    def add(self, path, pause = False):
+        job = dict(id = self.next_id, path = path, pause = pause,
+                   status = 'queued', error = None)
+        self.jobs.append(job)
+        self.next_id += 1
+        self._update()
+
+        return job['id']
+
+
+    def remove(self, id):
+        job = self._find(id)
+        if job is None: raise Exception('Job %d not found' % id)
+        if job['status'] == 'running':
+            raise Exception('Cannot remove running job')
+
+        self.jobs.remove(job)
+        if self.starting is job: self.starting = None
+        self._update()
+
+
+    def clear(self):
+        self.jobs = [job for job in self.jobs if job['status'] == 'running']
+        self.starting = None
+        self._update()
+
+
+    def start(self):
+        self.active = True
+        self._update()
+        self._run_next()
+
+
+    def hold(self):
+        # The running job finishes, the queue waits before the next one
+        self.active = False
+        self.starting = None
+        self._update()
+
+
+    def _check(self, job):
+        job['status'] = 'checking'
+        plan = self.checking = self.ctrl.preplanner.get_plan(job['path'])
+        self.ctrl.ioloop.add_future(plan, lambda f: self._checked(job, f))
+
+
+    def _check_next(self):
+        # Plan and validate the next job while the current one runs
+        pending = self._pending()
+        if len(pending) and pending[0]['status'] == 'queued':
+            self._check(pending[0])
+
+
+    def _validate(self, job, plan):
+        if not self.ctrl.fs.isfile(job['path']): return 'File not found'
+
+        data = plan.result()
+        if data is None: return 'Plan failed'
+        meta = data[0]
+
+        for msg in meta.get('messages', []):
+            if msg.get('level') in ('error', 'critical'):
+                return 'Line %s: %s' % (msg.get('line', '?'), msg['msg'])
+
+        config = self.ctrl.mach.planner.get_config(False, True)
+        bounds = meta.get('bounds', {})
+
+        for axis, value in bounds.get('min', {}).items():
+            if value < config['min-soft-limit'][axis]:
+                return '%s axis below soft limit' % axis.upper()
+
+        for axis, value in bounds.get('max', {}).items():
+            if config['max-soft-limit'][axis] < value:
+                return '%s axis above soft limit' % axis.upper()
+
+
+    def _checked(self, job, plan):
+        if plan is not self.checking or not self._is_queued(job): return
+        self.checking = None
+
+        try:
+            error = self._validate(job, plan)
+        except Exception as e: error = str(e)
+
+        job['status'] = 'invalid' if error else 'ready'
+        job['error'] = error
+        if error: self.log.warning('Job %d %s: %s' % (
+                job['id'], job['path'], error))
+        self._save()
+
+        if self.starting is job:
+            self.starting = None
+
+            # The machine may have started something else while checking
+            if self._is_busy(): self._hold_busy()
+            else: self._start_job(job)
+
+
+    def _start_job(self, job):
+        if job['status'] == 'invalid':
+            self.log.error('Queue held, job %d is invalid: %s' % (
+                job['id'], job['error']))
+            self.hold()
+            return
+
+        if job['status'] != 'ready':
+            self.starting = job
+            if job['status'] == 'queued': self._check(job)
+            return
+
+        try:
+            job['status'] = 'running'
+            self.ctrl.mach.start(job['path'])
+            self.log.info('Started job %d %s' % (job['id'], job['path']))
+
+        except Exception as e:
+            job['status'] = 'stopped'
+            job['error'] = str(e)
+            self.log.error('Failed to start job %d: %s' % (job['id'], e))
+            self.active = False
+
+        self._update()
+
+
+    def _run_next(self):
+        if not self.active or self.starting is not None: return
+
+        for job in self.jobs:
+            if job['status'] == 'running': return
+
+        if self._is_busy():
+            self._hold_busy()
+            return
+
+        pending = self._pending()
+        if not len(pending):
+            self.log.info('Job queue done')
+            self.hold()
+            return
+
+        self._start_job(pending[0])
+
+
+    def _end(self, path, completed):
+        job = None
+        for j in self.jobs:
+            if j['status'] == 'running' and j['path'] == path: job = j
+
+        if job is None: return # Not a queued job
+
+        job['status'] = 'done' if completed else 'stopped'
+        if not completed:
+            job['error'] = 'Stopped'
+            self.active = False
+
+        pending = self._pending()
+        if self.active and len(pending) and pending[0]['pause']:
+            self.log.info('Queue paused before job %d' % pending[0]['id'])
+            self.active = False
+
+        self._update()
+
+        # Leave the planner's end callbacks before starting the next job
+        if self.active: self.ctrl.ioloop.add_callback(self._run_next)
+
+
+    def _invalidate(self, path):
+        for job in self._pending():
+            if path is None or job['path'] == path:
+                job['status'] = 'queued'
+
+        self._update()
@@ -28,12 +28,24 @@
 import os
 import sys
 import io
+import time
+import threading
 import traceback
 from inspect import getframeinfo, stack
 
 from . import util
 
-__all__ = ['Log']
+__all__ = ['Log', 'Lazy']
+
+
+class Lazy(object):
+    # Log argument formatted only if the message is emitted
+    def __init__(self, cb, *args):
+        self.cb = cb
+        self.args = args
+
+
+    def __str__(self): return str(self.cb(*self.args))
 
 
 class Logger(object):
@@ -41,10 +53,56 @@ class Logger(object):
         self.log = log
         self.name = name
         self.level = level
+        self.set_budget()
 
 
     def set_level(self, level): self.level = level
-    def _enabled(self, level): return self.level <= level and level <= Log.ERROR
+
+
+    def set_budget(self, rate = None, sample = 1):
+        self.rate = rate     # Debug and info messages per second
+        self.sample = sample # Log one in every N debug and info messages
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.seen = 0
+        self.dropped = 0
+
+
+    def _admit(self, level):
+        if Log.MESSAGE <= level: return True
+        if self.rate is None and self.sample == 1: return True
+
+        self.seen += 1
+
+        if 1 < self.sample and self.seen % self.sample:
+            self.dropped += 1
+            return False
+
+        if self.rate is not None:
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            if self.tokens < 1:
+                self.dropped += 1
+                return False
+
+            self.tokens -= 1
+
+        return True
+
+
+    def summarize(self):
+        if not self.dropped: return
+
+        self.log._log('%d of %d messages not logged' % (
+            self.dropped, self.seen), prefix = self.name)
+        self.seen = self.dropped = 0
+
+
+    def is_enabled(self, level):
+        return self.level <= level and level <= Log.ERROR
 
 
     def _find_caller(self):
@@ -65,7 +123,7 @@ class Logger(object):
 
 
     def _log(self, level, msg, *args, **kwargs):
-        if not self._enabled(level): return
+        if not self.is_enabled(level) or not self._admit(level): return
 
         if not 'where' in kwargs:
             filename, line, func = self._find_caller()
@@ -101,8 +159,11 @@ class Log(object):
 
     def __init__(self, args, ioloop, path):
         self.path = path
+        self.ioloop = ioloop
+        self.thread = threading.current_thread()
         self.listeners = []
         self.loggers = {}
+        self.budgets = {}
 
         self.level = self.DEBUG if args.verbose else self.INFO
 
@@ -114,6 +175,10 @@ class Log(object):
         self._log('Log started v%s' % util.get_version())
         self._log_time(ioloop)
 
+        # Log volume budgets
+        for spec in args.log_budget: self.set_budget(spec)
+        if len(self.budgets): self._log_summaries(ioloop)
+
 
     def get_path(self): return self.path
 
@@ -124,14 +189,33 @@ class Log(object):
     def get(self, name, level = None):
         if not name in self.loggers:
             self.loggers[name] = Logger(self, name, self.level)
+
+            if name in self.budgets:
+                self.loggers[name].set_budget(*self.budgets[name])
+
         return self.loggers[name]
 
 
+    def set_budget(self, spec):
+        # NAME=RATE[/SAMPLE], e.g. Planner=20/10
+        name, limits = spec.split('=', 1)
+        rate, _, sample = limits.partition('/')
+        budget = (float(rate) if rate else None, int(sample or 1))
+
+        self.budgets[name] = budget
+        if name in self.loggers: self.loggers[name].set_budget(*budget)
+
+
     def _log_time(self, ioloop):
         self._log(util.timestamp())
         ioloop.call_later(60 * 60, self._log_time, ioloop)
 
 
+    def _log_summaries(self, ioloop):
+        for logger in self.loggers.values(): logger.summarize()
+        ioloop.call_later(60, self._log_summaries, ioloop)
+
+
     def broadcast(self, msg):
         for listener in self.listeners: listener(msg)
 
@@ -139,6 +223,11 @@ class Log(object):
     def _log(self, msg, level = INFO, prefix = '', where = None, time = False):
         if not msg: return
 
+        # Log from other threads on the main ioloop
+        if threading.current_thread() is not self.thread:
+            self.ioloop.add_callback(self._log, msg, level, prefix, where, time)
+            return
+
         hdr = '%s:%s:' % ('DIMWE'[level], prefix)
         if time: hdr += util.timestamp() + ':'
         s = hdr + ('\n' + hdr).join(msg.split('\n'))
@@ -25,7 +25,9 @@
 #                                                                              #
 ################################################################################
 
+import time
 from collections import deque
+from tornado import gen
 
 from . import Cmd
 from . import util
@@ -60,6 +62,7 @@ class Mach(Comm):
         self.unpausing = False
         self.stopping = False
         self.next_jog_id = 1
+        self.mdi_start = None # Time of the last MDI command, until it moves
 
         ctrl.state.set('cycle', 'idle')
         ctrl.state.add_listener(self._update)
@@ -110,9 +113,9 @@ class Mach(Comm):
 
         # Entering HOLDING state
         if state_changed and state == 'HOLDING':
-            # Always flush queue after pause
-            super().i2c_command(Cmd.FLUSH)
-            super().resume()
+            # Always flush queue after pause, resume once the flush is sent
+            flush = super().i2c_command(Cmd.FLUSH)
+            self.ctrl.ioloop.add_future(flush, lambda f: self.resume())
 
         # Automatically unpause after seek or stop hold
         # Must be after holding commands above
@@ -162,6 +165,7 @@ class Mach(Comm):
         if program.start(self, self.planner):
             self.programs.append(program)
             self._update_cycle()
+            self.planner.fill() # Start motion without waiting for the ioloop
 
 
     def end(self, program):
@@ -171,6 +175,12 @@ class Mach(Comm):
         self.programs.popleft()
         self._update_cycle()
 
+        if program.status == 'mdi': self.mdi_start = None
+
+        if program.status == 'running':
+            completed = self.planner.end_reason == 'Program end'
+            self.ctrl.events.emit('program-end', program.path, completed)
+
 
     def end_jog(self, id):
         if not id: return # Ignore ID 0
@@ -199,7 +209,7 @@ class Mach(Comm):
 
 
     def set(self, code, value):
-        super().queue_command('${}={}'.format(code, value))
+        super().queue_command('${}={}'.format(code, value), key = '$' + code)
 
 
     def step(self): raise Exception('NYI') # TODO
@@ -224,7 +234,9 @@ class Mach(Comm):
 
 
     def mdi(self, cmd, with_limits = True):
+        start = time.time()
         self._run(ProgramMDI(self.ctrl, cmd, with_limits))
+        if self._get_cycle() == 'mdi': self.mdi_start = start
 
 
     def jog(self, axes):
@@ -241,7 +253,80 @@ class Mach(Comm):
     def unhome(self, axis): self.mdi('G28.2 %c0' % axis)
 
 
-    def start(self, path): self._run(ProgramFile(self.ctrl, path))
+    def start(self, path, from_line = None):
+        # Render TPL programs and hash recorded programs off the ioloop
+        if self._is_prepared(path): self._start(path, from_line)
+        else:
+            prepare = self._prepare(path)
+            self.ctrl.ioloop.add_future(
+                prepare, lambda f: self._start_prepared(path, from_line, f))
+
+
+    def _is_prepared(self, path):
+        if self.ctrl.tpl.needs_render(path): return False
+        if not self.planner.runs.is_enabled(path): return True
+        return self.ctrl.hashes.lookup(self.ctrl.tpl.get(path)) is not None
+
+
+    @gen.coroutine
+    def _prepare(self, path):
+        gcode = yield self.ctrl.tpl.render(path)
+        if self.planner.runs.is_enabled(path): yield self.ctrl.hashes.get(gcode)
+
+
+    def _start_failed(self, path, e, line = None):
+        where = path if line is None else '%s at line %d' % (path, line)
+        self.mlog.error('Cannot start %s: %s' % (where, e))
+        self.ctrl.events.emit('program-end', path, False)
+
+
+    def _start_prepared(self, path, from_line, prepare):
+        try:
+            prepare.result()
+            self._start(path, from_line)
+
+        except Exception as e: self._start_failed(path, e)
+
+
+    def _start(self, path, from_line):
+        if from_line is None or from_line <= 1:
+            self._run(ProgramFile(self.ctrl, path))
+            return
+
+        # Start from a checkpoint once the preplanner has the program
+        preplanner = self.ctrl.preplanner
+        plan = preplanner.get_plan(path, preplanner.ACTIVE)
+        self.ctrl.ioloop.add_future(
+            plan, lambda f: self._start_from(path, from_line, f))
+
+
+    def _start_from(self, path, line, plan):
+        try:
+            if plan.result() is None: raise Exception('Plan failed')
+            checkpoints = plan.result()[0].get('checkpoints', [])
+            checkpoints = [cp for cp in checkpoints if cp['line'] <= line]
+
+            if not len(checkpoints):
+                self.mlog.info('No checkpoint before line %d' % line)
+                self._run(ProgramFile(self.ctrl, path))
+                return
+
+            cp = checkpoints[-1]
+            write = self.planner.write_checkpoint(self.ctrl.tpl.get(path), cp)
+            self.ctrl.ioloop.add_future(
+                write, lambda f: self._start_checkpoint(path, cp, f))
+
+        except Exception as e:
+            self._start_failed(path, e, line)
+
+
+    def _start_checkpoint(self, path, cp, write):
+        try:
+            cp = dict(cp, gcode = write.result())
+            self._run(ProgramFile(self.ctrl, path, checkpoint = cp))
+
+        except Exception as e:
+            self._start_failed(path, e, cp['line'])
 
 
     def set_position(self, axis, position):
@@ -249,11 +334,25 @@ class Mach(Comm):
 
 
     # Comm methods
+    def _update_state(self, update):
+        super()._update_state(update)
+
+        # Time from MDI command to motion as reported by the AVR
+        if self.mdi_start is not None and update.get('xx') == 'RUNNING':
+            latency = time.time() - self.mdi_start
+            self.ctrl.state.set('mdi_latency', round(latency * 1000))
+            self.mdi_start = None
+
+
     def comm_next(self):
         cmd = None
 
-        if self.planner.is_running() and not self._is_holding():
-            cmd = self.planner.next()
+        if self._is_holding(): pass
+
+        # The motion thread only takes commands already encoded by the planner
+        elif self.motion is not None: cmd = self.planner.next(False)
+
+        elif self.planner.is_running(): cmd = self.planner.next()
 
         return cmd
 
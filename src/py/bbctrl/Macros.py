@@ -0,0 +1,99 @@
+################################################################################
+#                                                                              #
+#                 This file is part of the Buildbotics firmware.               #
+#                                                                              #
+#        Copyright (c) 2015 - 2021, Buildbotics LLC, All rights reserved.      #
+#                                                                              #
+#         This Source describes Open Hardware and is licensed under the        #
+#                                 CERN-OHL-S v2.                               #
+#                                                                              #
+#         You may redistribute and modify this Source and make products        #
+#    using it under the terms of the CERN-OHL-S v2 (https:/cern.ch/cern-ohl).  #
+#           This Source is distributed WITHOUT ANY EXPRESS OR IMPLIED          #
+#    WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS  #
+#     FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-S v2 for applicable    #
+#                                  conditions.                                 #
+#                                                                              #
+#                Source location: https://github.com/buildbotics               #
+#                                                                              #
+#      As per CERN-OHL-S v2 section 4, should You produce hardware based on    #
+#    these sources, You must maintain the Source Location clearly visible on   #
+#    the external case of the CNC Controller or other product you make using   #
+#                                  this Source.                                #
+#                                                                              #
+#                For more information, email info@buildbotics.com              #
+#                                                                              #
+################################################################################
+
+
+import os
+
+__all__ = ['Macros']
+
+
+class Macros(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+        self.log = ctrl.log.get('Macros')
+        self.gcode = {} # Macro G-code by path
+        self.paths = set()
+        self.runs = {} # Recorded run key by macro path
+
+        ctrl.events.on('invalidate', self._invalidate)
+        ctrl.events.on('invalidate-all', self.load)
+
+
+    def _load(self, path):
+        realpath = self.ctrl.fs.realpath(path)
+
+        # TPL macros must be run by the planner from their file
+        ext = os.path.splitext(realpath)[1]
+        if ext == '.tpl' or not os.path.isfile(realpath):
+            self.gcode.pop(path, None)
+            return
+
+        try:
+            stat = os.stat(realpath)
+            with open(realpath, 'r') as f: gcode = f.read()
+            self.gcode[path] = (stat.st_mtime_ns, stat.st_size, gcode)
+
+        except Exception:
+            self.gcode.pop(path, None)
+            self.log.exception('Loading macro %s' % path)
+
+
+    def load(self):
+        self.gcode = {}
+        self.paths = set()
+        self.runs = {}
+
+        for macro in self.ctrl.config.get('macros', []):
+            if macro.get('path'): self.paths.add('Home/' + macro['path'])
+
+        for path in self.paths: self._load(path)
+
+        self.log.info('Loaded %d macros' % len(self.gcode))
+
+
+    def _invalidate(self, path):
+        if path in self.gcode: self._load(path)
+        self.runs.pop(path, None)
+
+
+    def is_macro(self, path): return path in self.paths
+    def set_run(self, path, key): self.runs[path] = key
+    def get_runs(self): return self.runs.values()
+
+
+    def get(self, path):
+        # Returns the macro's G-code, None if not loaded or the file changed
+        if not path in self.gcode: return
+
+        mtime, size, gcode = self.gcode[path]
+
+        try:
+            stat = os.stat(self.ctrl.fs.realpath(path))
+            if stat.st_mtime_ns == mtime and stat.st_size == size: return gcode
+        except OSError: pass
+
+        self._load(path)
@@ -0,0 +1,82 @@
+################################################################################
+#                                                                              #
+#                 This file is part of the Buildbotics firmware.               #
+#                                                                              #
+#        Copyright (c) 2015 - 2021, Buildbotics LLC, All rights reserved.      #
+#                                                                              #
+#         This Source describes Open Hardware and is licensed under the        #
+#                                 CERN-OHL-S v2.                               #
+#                                                                              #
+#         You may redistribute and modify this Source and make products        #
+#    using it under the terms of the CERN-OHL-S v2 (https:/cern.ch/cern-ohl).  #
+#           This Source is distributed WITHOUT ANY EXPRESS OR IMPLIED          #
+#    WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS  #
+#     FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-S v2 for applicable    #
+#                                  conditions.                                 #
+#                                                                              #
+#                Source location: https://github.com/buildbotics               #
+#                                                                              #
+#      As per CERN-OHL-S v2 section 4, should You produce hardware based on    #
+#    these sources, You must maintain the Source Location clearly visible on   #
+#    the external case of the CNC Controller or other product you make using   #
+#                                  this Source.                                #
+#                                                                              #
+#                For more information, email info@buildbotics.com              #
+#                                                                              #
+################################################################################
+
+import os
+import threading
+import tornado.ioloop
+
+from .IOLoop import *
+
+__all__ = ['MotionThread']
+
+
+class MotionThread(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+        self.log = ctrl.log.get('Motion')
+        self.ioloop = None
+
+        # Serial I/O runs on its own ioloop so that web, camera and LCD work
+        # on the main ioloop cannot delay it
+        started = threading.Event()
+        self.thread = threading.Thread(target = self._run, args = (started,),
+                                       name = 'motion', daemon = True)
+        self.thread.start()
+        started.wait()
+
+
+    def close(self):
+        if self.ioloop is None: return
+
+        ioloop, self.ioloop = self.ioloop, None
+        ioloop.ioloop.add_callback(ioloop.close)
+        ioloop.ioloop.add_callback(ioloop.ioloop.stop)
+        self.thread.join()
+
+
+    def _set_priority(self):
+        priority = self.ctrl.args.motion_priority
+        if not priority: return
+
+        try:
+            # Applies to the calling thread only
+            param = os.sched_param(priority)
+            os.sched_setscheduler(0, os.SCHED_FIFO, param)
+
+        except Exception as e:
+            self.log.warning('Failed to set motion thread priority: %s', e)
+
+
+    def _run(self, started):
+        self._set_priority()
+
+        ioloop = tornado.ioloop.IOLoop()
+        self.ioloop = IOLoop(ioloop)
+        started.set()
+
+        ioloop.start()
+        ioloop.close()
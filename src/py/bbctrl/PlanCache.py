@@ -0,0 +1,168 @@
+################################################################################
+#                                                                              #
+#                 This file is part of the Buildbotics firmware.               #
+#                                                                              #
+#        Copyright (c) 2015 - 2021, Buildbotics LLC, All rights reserved.      #
+#                                                                              #
+#         This Source describes Open Hardware and is licensed under the        #
+#                                 CERN-OHL-S v2.                               #
+#                                                                              #
+#         You may redistribute and modify this Source and make products        #
+#    using it under the terms of the CERN-OHL-S v2 (https:/cern.ch/cern-ohl).  #
+#           This Source is distributed WITHOUT ANY EXPRESS OR IMPLIED          #
+#    WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS  #
+#     FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-S v2 for applicable    #
+#                                  conditions.                                 #
+#                                                                              #
+#                Source location: https://github.com/buildbotics               #
+#                                                                              #
+#      As per CERN-OHL-S v2 section 4, should You produce hardware based on    #
+#    these sources, You must maintain the Source Location clearly visible on   #
+#    the external case of the CNC Controller or other product you make using   #
+#                                  this Source.                                #
+#                                                                              #
+#                For more information, email info@buildbotics.com              #
+#                                                                              #
+################################################################################
+
+
+import os
+import json
+import time
+
+__all__ = ['PlanCache']
+
+
+# Files of a plan, after its key
+plan_files = ('json', 'positions.gz', 'speeds.gz', 'profile.gz')
+
+
+class PlanCache(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+        self.log = ctrl.log.get('PlanCache')
+        self.dir = ctrl.get_plan()
+        self.path = ctrl.get_plan('index.json')
+        self.max_bytes = ctrl.args.plan_cache_size * 1024 * 1024
+        self.index = {} # Plan size, last access and source path by key
+        self.save_timeout = None
+
+        self._load()
+
+
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f: self.index = json.load(f)
+
+        except Exception: self.log.exception('Failed to load plan index')
+
+        self._reconcile()
+
+
+    def _reconcile(self):
+        # The index may be older than the plans on disk, adopt plans it is
+        # missing, delete incomplete plans and drop entries without files
+        index, self.index = self.index, {}
+        adopted = 0
+
+        keys = set()
+        for name in os.listdir(self.dir):
+            for suffix in plan_files:
+                if name.endswith('.' + suffix) and name != 'index.json':
+                    keys.add(name[:-len(suffix)])
+
+        for key in keys:
+            files = self.get_files(key)
+
+            try:
+                size = sum(os.path.getsize(path) for path in files)
+            except OSError:
+                self._delete(key)
+                continue
+
+            entry = index.get(key)
+            if entry is None:
+                entry = dict(path = None, atime = os.path.getmtime(files[0]))
+                adopted += 1
+
+            entry['size'] = size
+            self.index[key] = entry
+
+        self.log.info('Loaded %d plans, adopted %d' % (len(self.index),
+                                                      adopted))
+        self._evict()
+        self._save()
+
+
+    def _save(self):
+        self.save_timeout = None
+
+        try:
+            with open(self.path + '.tmp', 'w') as f: json.dump(self.index, f)
+            os.replace(self.path + '.tmp', self.path)
+
+        except Exception: self.log.exception('Failed to save plan index')
+
+
+    def _changed(self):
+        if self.save_timeout is None:
+            self.save_timeout = self.ctrl.ioloop.call_later(5, self._save)
+
+
+    def _delete(self, key):
+        for name in plan_files:
+            try:
+                os.unlink(self.dir + '/' + key + name)
+            except OSError: pass
+
+
+    def _evict(self, keep = None):
+        # Drop least recently used plans until under the size limit
+        total = sum(entry['size'] for entry in self.index.values())
+        lru = sorted(self.index.items(), key = lambda item: item[1]['atime'])
+
+        for key, entry in lru:
+            if total <= self.max_bytes: break
+            if key == keep: continue
+
+            self.remove(key)
+            total -= entry['size']
+
+
+    def get_files(self, key):
+        return [self.dir + '/' + key + name for name in plan_files]
+
+
+    def has(self, key):
+        if not key in self.index: return False
+
+        for path in self.get_files(key):
+            if not os.path.exists(path):
+                self.remove(key)
+                return False
+
+        self.index[key]['atime'] = time.time()
+        self._changed()
+        return True
+
+
+    def add(self, key, path):
+        size = sum(os.path.getsize(p) for p in self.get_files(key))
+        self.index[key] = dict(path = path, size = size, atime = time.time())
+        self._evict(key)
+        self._changed()
+
+
+    def remove(self, key):
+        if key in self.index:
+            del self.index[key]
+            self._changed()
+
+        self._delete(key)
+
+
+    def remove_source(self, path):
+        # Plans of a changed or deleted program are no longer needed
+        for key, entry in list(self.index.items()):
+            if entry['path'] == path: self.remove(key)
@@ -25,14 +25,20 @@
 #                                                                              #
 ################################################################################
 
+import os
 import json
 import math
 import re
 import time
+import shutil
 from collections import deque
+from tornado.concurrent import run_on_executor
+from concurrent.futures import ThreadPoolExecutor
 
 from . import Cmd
 from .CommandQueue import *
+from .Log import *
+from .RunCache import *
 
 try:
     from . import camotics # pylint: disable=no-name-in-module,import-error
@@ -50,6 +56,17 @@ reLogLine = re.compile(
     r'(?P<msg>.*)$')
 
 
+# State and config values get_config() depends on
+config_state_vars = ['metric'] + [
+    '%d%s' % (motor, var) for motor in range(4)
+    for var in ('an', 'me', 'vm', 'am', 'jm', 'tn', 'tm', 'homed')]
+config_vars = ['tool-type', 'max-deviation', 'rapid-auto-off',
+               'junction-accel', 'program-start', 'tool-change', 'program-end']
+
+
+log_levels = dict(D = Log.DEBUG, I = Log.INFO, W = Log.WARNING, E = Log.ERROR)
+
+
 def log_floats(o):
     if isinstance(o, float): return round(o, 2)
     if isinstance(o, dict): return {k: log_floats(v) for k, v in o.items()}
@@ -57,18 +74,66 @@ def log_floats(o):
     return o
 
 
-def log_json(o): return json.dumps(log_floats(o))
+def log_json(o): return Lazy(lambda: json.dumps(log_floats(o)))
+
+
+def checkpoint_gcode(cp):
+    # Move to a preplanner checkpoint and restore its G-code state
+    modal, position = cp['modal'], cp['position']
+    lines = ['G21 G49'] # Machine coordinates in mm without tool offset
+
+    if cp.get('tool') is not None: lines.append('T%d' % cp['tool'])
+    if modal['spindle'] == 'M5': lines.append('M5')
+    elif modal['spindle']: lines.append('S%g %s' % (cp['speed'] or 0,
+                                                    modal['spindle']))
+    if modal['coolant']: lines.append(modal['coolant'])
+
+    if cp.get('safe_z') is not None: lines.append('G53 G0 Z%.4f' % cp['safe_z'])
+
+    axes = ['%s%.4f' % (axis.upper(), position[axis])
+            for axis in 'xyabc' if axis in position]
+    if axes: lines.append('G53 G0 ' + ' '.join(axes))
+
+    # Plunge in the program's motion mode
+    if modal['motion'] in ('G1', 'G2', 'G3'):
+        if not modal['feed']: raise Exception('Checkpoint feed rate not set')
+        feed = modal['feed'] * (25.4 if modal.get('units') == 'G20' else 1)
+        if 'z' in position:
+            lines.append('G53 G1 Z%.4f F%.4f' % (position['z'], feed))
+
+    elif 'z' in position: lines.append('G53 G0 Z%.4f' % position['z'])
+
+    words = [modal[group] for group in ('plane', 'units', 'cutter', 'distance',
+                                        'feedmode', 'coords', 'length')
+             if modal.get(group)]
+    if modal['feed']: words.append('F%.4f' % modal['feed'])
+    if words: lines.append(' '.join(words))
+
+    return lines
 
 
 class Planner():
+    executor = ThreadPoolExecutor(max_workers = 1)
+
+
     def __init__(self, ctrl):
         self.ctrl = ctrl
         self.log = ctrl.log.get('Planner')
         self.cmdq = CommandQueue(ctrl)
         self.end_callbacks = deque()
         self.planner = None
+        self.ready = deque() # Encoded commands waiting for the serial writer
+        self.lookahead = ctrl.args.planner_lookahead
+        self.fill_pending = False
         self._position_dirty = False
         self.where = ''
+        self.configs = {} # Cached configs by (with_start, with_limits)
+        self.runs = RunCache(ctrl)
+        self.replay = None
+        self.id_offset = 0  # Command IDs sent to the AVR minus planner IDs
+        self.anchor = False # Set id_offset on the next planner block
+        self.line_offset = 0
+        self.end_reason = None # Message of the last program end
 
         ctrl.state.add_listener(self._update)
 
@@ -80,7 +145,10 @@ class Planner():
 
 
     def is_busy(self): return self.is_running() or self.cmdq.is_active()
-    def is_running(self): return self.planner.is_running()
+    def is_running(self):
+        return (len(self.ready) or self.replay is not None or
+                self.planner.is_running())
+
     def position_change(self): self._position_dirty = True
 
 
@@ -91,6 +159,19 @@ class Planner():
 
 
     def get_config(self, with_start, with_limits):
+        # Reuse the last config unless its state or config values changed
+        key = (self.ctrl.state.get_values(config_state_vars),
+               tuple(self.ctrl.config.get(name) for name in config_vars))
+        cached = self.configs.get((with_start, with_limits))
+
+        if cached is None or cached[0] != key:
+            cfg = self._get_config(with_start, with_limits)
+            cached = self.configs[(with_start, with_limits)] = (key, cfg)
+
+        return dict(cached[1])
+
+
+    def _get_config(self, with_start, with_limits):
         state = self.ctrl.state
         config = self.ctrl.config
         is_pwm = config.get('tool-type') == 'PWM Spindle'
@@ -137,7 +218,7 @@ class Planner():
 
         if overrides: cfg['overrides'] = overrides
 
-        self.log.info('Config:' + log_json(cfg))
+        self.log.info('Config:%s', log_json(cfg))
 
         return cfg
 
@@ -145,8 +226,13 @@ class Planner():
     def _update(self, update):
         if 'id' in update:
             id = update['id']
-            self.planner.set_active(id) # Release planner commands
+
+            # Release planner commands
+            if self.replay is None:
+                self.planner.set_active((id - self.id_offset) & 0xffff)
+
             self.cmdq.release(id)       # Synchronize planner variables
+            self._schedule_fill()       # Released commands may allow more
 
 
     def _get_var_cb(self, name, units):
@@ -159,13 +245,19 @@ class Planner():
                 if units == 'IMPERIAL': value /= 25.4 # Assume metric
             except ValueError: value = 0
 
-        self.log.info('Get: %s=%s (units=%s)' % (name, value, units))
+        self.log.info('Get: %s=%s (units=%s)', name, value, units)
+        self.runs.abort() # Do not record variable dependent programs
 
         return value
 
 
     def _log_cb(self, line):
         line = line.strip()
+
+        # Skip parsing lines below the log level
+        level = log_levels.get(line[:1])
+        if level is not None and not self.log.is_enabled(level): return
+
         m = reLogLine.match(line)
         if not m: return
 
@@ -245,18 +337,19 @@ class Planner():
         self.plan_time += block['seconds']
 
 
-    def __encode(self, block):
+    def __encode(self, block, frames):
         type, id = block['type'], block['id']
 
         if type == 'start': return # ignore
 
-        if type != 'set': self.log.info('Cmd:' + log_json(block))
+        if type != 'set': self.log.info('Cmd:%s', log_json(block))
 
         if type == 'line':
             self._enqueue_line_time(block)
-            return Cmd.line(block['target'], block['exit-vel'],
-                            block['max-accel'], block['max-jerk'],
-                            block['times'], block.get('speeds', []))
+            encode = Cmd.line_frame if Cmd.LINE in frames else Cmd.line
+            return encode(block['target'], block['exit-vel'],
+                          block['max-accel'], block['max-jerk'],
+                          block['times'], block.get('speeds', []))
 
         if type == 'set':
             name, value = block['name'], block['value']
@@ -264,6 +357,7 @@ class Planner():
             if name == 'message':
                 self.cmdq.enqueue(id, self._add_message, value)
 
+            if name == 'line': value += self.line_offset
             if name in ['line', 'tool']: self._enqueue_set_cmd(id, name, value)
 
             if name == 'speed':
@@ -288,6 +382,8 @@ class Planner():
 
             return
 
+        if type in ('input', 'seek'): self.runs.abort()
+
         if type == 'input':
             # TODO handle timeout
             self.planner.synchronize(0) # TODO Fix this
@@ -307,6 +403,7 @@ class Planner():
             return Cmd.seek(sw, block['active'], block['error'])
 
         if type == 'end':
+            self.cmdq.enqueue(id, self.runs.save)
             self.cmdq.enqueue(id, self._end_program, 'Program end')
             return '' # Blank command still sends command id
 
@@ -314,12 +411,17 @@ class Planner():
 
 
     def _encode(self, block):
-        cmd = self.__encode(block)
+        frames = self.ctrl.mach.frames
+        cmd = self.__encode(block, frames)
 
         if cmd is not None:
             # Enqueue id with no callback to track command activity
             self.cmdq.enqueue(block['id'], None)
-            return Cmd.set_sync('id', block['id']) + '\n' + cmd
+
+            if Cmd.SET_SYNC in frames:
+                return Cmd.join(Cmd.set_sync_frame('id', block['id']), cmd)
+
+            return Cmd.join(Cmd.set_sync('id', block['id']), cmd)
 
 
     def reset_times(self):
@@ -339,18 +441,33 @@ class Planner():
     def reset(self, stop = True):
         self._end_program('Program reset', True)
         if stop: self.ctrl.mach.stop()
-        self.planner = camotics.Planner()
-        self.planner.set_resolver(self._get_var_cb)
-        # TODO logger is global and will not work correctly in demo mode
-        camotics.set_logger(self._log_cb, 1, 'LinePlanner:3')
+        self._reset_planner()
         self._position_dirty = True
+        self.ready.clear()
         self.cmdq.clear()
+        self.runs.abort()
+        self._end_replay()
         self.reset_times()
         self.ctrl.state.reset()
 
 
+    def _reset_planner(self):
+        # Reuse the planner if it can be stopped
+        if self.planner is not None:
+            try:
+                self.planner.stop()
+                return
+            except: self.log.exception()
+
+        self.planner = camotics.Planner()
+        self.planner.set_resolver(self._get_var_cb)
+        # TODO logger is global and will not work correctly in demo mode
+        camotics.set_logger(self._log_cb, 1, 'LinePlanner:3')
+
+
     def _end_program(self, msg = None, end_all = False):
         self.ctrl.state.set('active_program', None)
+        self.end_reason = msg
 
         if end_all:
             while len(self.end_callbacks):
@@ -361,7 +478,8 @@ class Planner():
         if msg is not None: self.log.info(msg, time = True)
 
 
-    def load(self, cb, path, mdi = None, with_start = True, with_limits = True):
+    def load(self, cb, path, mdi = None, with_start = True, with_limits = True,
+             checkpoint = None):
         self.end_callbacks.append(cb)
         self.where = path
         self.log.info('Start: ' + path, time = True)
@@ -369,16 +487,102 @@ class Planner():
         self._sync_position()
 
         config = self.get_config(with_start, with_limits)
+        self.anchor = True
+        self.line_offset = 0
+
         if mdi is not None: self.planner.load_string(mdi, config)
-        else: self.planner.load(self.ctrl.fs.realpath(path), config)
+        elif checkpoint is not None: self._load_checkpoint(checkpoint, config)
+        elif not self._start_run(path, config):
+            gcode = self.ctrl.macros.get(path) # Preloaded macro
+            if gcode is not None: self.planner.load_string(gcode, config)
+            else: self.planner.load(self.ctrl.tpl.get(path), config)
 
         self.reset_times()
+        if checkpoint is not None: self.plan_time = checkpoint['time']
+        self._schedule_fill()
+
+
+    @run_on_executor
+    def write_checkpoint(self, path, cp):
+        # The checkpoint's state followed by the rest of the program, copied
+        # off the ioloop
+        gcode = self.ctrl.get_path(filename = 'checkpoint.nc')
+        tmp = gcode + '.tmp'
+
+        with open(path, 'rb') as src:
+            with open(tmp, 'wb') as dst:
+                for line in checkpoint_gcode(cp):
+                    dst.write((line + '\n').encode('utf8'))
+
+                src.seek(cp['offset'])
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+        os.replace(tmp, gcode)
+        return gcode
+
+
+    def _load_checkpoint(self, cp, config):
+        # Plan only the rest of the program, after restoring its state
+        self.log.info('Starting at line %d' % cp['line'])
+        self.line_offset = cp['line'] - 1 - len(checkpoint_gcode(cp))
+        self.planner.load(cp['gcode'], config)
+
+
+    def _start_run(self, path, config):
+        # Replay a recorded run or record this one, True if replaying
+        gcode = self.ctrl.tpl.get(path)
+        if (not self.runs.is_enabled(path) or
+            os.path.splitext(gcode)[1] == '.tpl'): return False
+
+        position = self.ctrl.state.get_position()
+        key = self.runs.key(gcode, config, position)
+        if key is None: return False
+        if self.ctrl.macros.is_macro(path): self.ctrl.macros.set_run(path, key)
+        self.replay = self.runs.replay(key, gcode, config, position)
+        if self.replay is None: self.runs.record(key)
+
+        return self.replay is not None
+
+
+    def _end_replay(self):
+        if self.replay is not None:
+            self.replay.close()
+            self.replay = None
+
+
+    def _replay_to_live(self, id, position):
+        # Plan the replayed program live up to the restart point
+        replay = self.replay
+        index = replay.index(id)
+        self._end_replay()
+
+        self.planner.set_position(replay.position)
+        self.planner.load(replay.gcode, replay.config)
+        if index < 0: return # Nothing run yet, start from the beginning
+
+        count = 0
+        while self.planner.has_more():
+            block = self.planner.next()
+            self.planner.set_active(block['id'])
+            if self.planner.is_synchronizing(): self.planner.synchronize(0)
+
+            if count == index:
+                self.id_offset = (id - block['id']) & 0xffff
+                self.planner.restart(block['id'], position)
+                return
+
+            count += 1
+
+        raise Exception('Recorded run does not match program')
 
 
     def stop(self):
         try:
             self.planner.stop()
+            self.ready.clear()
             self.cmdq.clear()
+            self.runs.abort()
+            self._end_replay()
             self._end_program('Program stop', True)
 
         except:
@@ -391,22 +595,82 @@ class Planner():
             id = self.ctrl.state.get('id')
             position = self.ctrl.state.get_position()
 
-            self.log.info('Planner restart: %d %s' % (id, log_json(position)))
+            self.log.info('Planner restart: %d %s', id, log_json(position))
 
+            self.ready.clear()
             self.cmdq.clear()
             self.cmdq.release(id)
             self._plan_time_restart()
-            self.planner.restart(id, position)
+            self.runs.abort() # A restarted run differs from its recording
+
+            if self.replay is not None: self._replay_to_live(id, position)
+            else: self.planner.restart((id - self.id_offset) & 0xffff, position)
+
+            self._schedule_fill()
 
         except:
             self.log.exception()
             self.stop()
 
 
-    def next(self):
+    def _schedule_fill(self):
+        if not self.fill_pending:
+            self.fill_pending = True
+            self.ctrl.ioloop.add_callback(self.fill)
+
+
+    def fill(self):
+        # Encode commands ahead of the serial writer, outside its handler
+        self.fill_pending = False
+        count = len(self.ready)
+
+        while len(self.ready) < self.lookahead:
+            cmd = self._next()
+            if cmd is None: break
+            self.ready.append(cmd)
+
+        if count < len(self.ready): self.ctrl.mach.flush() # Wake writer
+
+
+    def next(self, encode = True):
+        try:
+            cmd = self.ready.popleft()
+            self._schedule_fill()
+            return cmd
+
+        except IndexError: pass # May be cleared from another thread
+
+        if encode: return self._next()
+        self._schedule_fill()
+
+
+    def _next_block(self):
+        if self.replay is not None:
+            block = self.replay.next(self.cmdq.next_id())
+            if block is None: self._end_replay()
+            return block
+
+        if not self.planner.has_more(): return
+
+        block = self.planner.next()
+        self.runs.add(block)
+
+        # Send IDs following those already queued
+        if self.anchor:
+            self.anchor = False
+            self.id_offset = (self.cmdq.next_id() - block['id']) & 0xffff
+
+        block['id'] = (block['id'] + self.id_offset) & 0xffff
+
+        return block
+
+
+    def _next(self):
         try:
-            while self.planner.has_more():
-                cmd = self._encode(self.planner.next())
+            while True:
+                block = self._next_block()
+                if block is None: break
+                cmd = self._encode(block)
                 if cmd is not None: return cmd
 
         except RuntimeError as e:
@@ -28,8 +28,11 @@
 import os
 import time
 import json
+import gzip
+import zlib
+import struct
+import bisect
 import hashlib
-import glob
 import tempfile
 import signal
 import shutil
@@ -37,6 +40,7 @@ from concurrent.futures import Future
 from tornado import gen, process, iostream
 
 from . import util
+from .PlanCache import *
 
 __all__ = ['Preplanner']
 
@@ -46,16 +50,12 @@ def hash_dump(o):
     return s.encode('utf8')
 
 
-def plan_hash(path, config):
+def plan_hash(digest, config):
+    # The G-code file's SHA-256 comes from HashCache
     h = hashlib.sha256()
-    h.update('v4'.encode('utf8'))
+    h.update('v8'.encode('utf8'))
     h.update(hash_dump(config))
-
-    with open(path, 'rb') as f:
-        while True:
-            buf = f.read(1024 * 1024)
-            if not buf: break
-            h.update(buf)
+    h.update(digest.encode('utf8'))
 
     return h.hexdigest()
 
@@ -66,6 +66,55 @@ def safe_remove(path):
     except: pass
 
 
+class Worker(object):
+    def __init__(self, preplanner):
+        self.recycle = False
+
+        cmd = ('/usr/bin/env', 'python3', util.get_resource('plan.py'),
+               '--worker')
+        preplanner.log.info('Running: %s', cmd)
+
+        self.proc = process.Subprocess(cmd, stdin = process.Subprocess.STREAM,
+                                       stdout = process.Subprocess.STREAM)
+        self.pid = self.proc.proc.pid
+
+
+    def is_alive(self):
+        return not self.recycle and not self.proc.stdout.closed()
+
+
+    def close(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except: pass
+
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait_for_exit(False) # Reap
+
+
+    @gen.coroutine
+    def plan(self, job, update):
+        self.recycle = True # Unless the job ends cleanly
+
+        try:
+            data = json.dumps(job, separators = (',', ':')) + '\n'
+            yield self.proc.stdin.write(data.encode('utf8'))
+
+            while True:
+                line = yield self.proc.stdout.read_until(b'\n')
+                msg = json.loads(line.decode('utf8'))
+                if msg.get('done'): break
+                update(msg)
+
+        except iostream.StreamClosedError:
+            self.recycle = True
+            raise Exception('Plan worker exited')
+
+        self.recycle = msg['recycle']
+        if msg['error']: raise Exception('Plan failed: ' + msg['error'])
+
+
 class Plan(object):
     def __init__(self, preplanner, ctrl, path):
         self.preplanner = preplanner
@@ -78,33 +127,52 @@ class Plan(object):
         self.progress = 0
         self.cancel = False
         self.pid = None
+        self.priority = Preplanner.BACKGROUND
+        self.seq = 0        # Order of the last request
+        self.requested = 0  # Time of the last request
+        self.slot = None    # Resolved when a worker is free
+        self.tmpdir = None  # Output directory while planning
+        self.files = []
+        self.chunks = []    # Points and file offsets of streamed chunks
+        self.readers = {}   # Open planned streams and bytes read by type
 
-        self.gcode = ctrl.fs.realpath(path)
-        self.base = '%s/plans/%s' % (ctrl.root, os.path.basename(path))
-        self.hid = plan_hash(self.gcode, self.config)
-        fbase = '%s.%s.' % (self.base, self.hid)
-        self.files = [
-            fbase + 'json',
-            fbase + 'positions.gz',
-            fbase + 'speeds.gz']
+        self.ctrl = ctrl
+        self.path = path
 
         self.future = Future()
         ctrl.ioloop.add_callback(self._load)
 
 
+    def request(self, priority, seq):
+        self.priority = min(self.priority, priority)
+        self.seq = seq
+        self.requested = time.time()
+
+
     def terminate(self):
         if self.cancel: return
         self.cancel = True
+        self.preplanner.dequeue(self)
         if self.pid is not None:
             try:
                 os.kill(self.pid, signal.SIGKILL)
             except: pass
 
+        self._close_readers()
 
-    def _exists(self):
-        for path in self.files:
-            if not os.path.exists(path): return False
-        return True
+
+    def _close_readers(self):
+        for f, offset in self.readers.values(): f.close()
+        self.readers = {}
+
+
+    def _exists(self): return self.preplanner.cache.has(self.key)
+
+
+    def is_evicted(self):
+        # Planned, but its files have since left the plan cache
+        return (self.future.done() and self.future.result() is not None and
+                not self._exists())
 
 
     def _read(self):
@@ -119,63 +187,128 @@ class Plan(object):
 
         except:
             self.preplanner.log.exception()
-
-            # Clean
-            for path in self.files:
-                if os.path.exists(path):
-                    os.remove(path)
+            self.preplanner.cache.remove(self.key)
 
 
     @gen.coroutine
     def _exec(self):
+        yield self.preplanner.acquire(self)
+
+        try:
+            if not self.cancel: yield self._run()
+        finally: self.preplanner.release(self)
+
+
+    @gen.coroutine
+    def _run(self):
         with tempfile.TemporaryDirectory() as tmpdir:
-            cmd = (
-                '/usr/bin/env', 'python3',
-                util.get_resource('plan.py'),
-                os.path.abspath(self.gcode), json.dumps(self.state),
-                json.dumps(self.config),
-                '--max-time=%s' % self.preplanner.max_plan_time,
-                '--max-loop=%s' % self.preplanner.max_loop_time
-            )
-
-            self.preplanner.log.info('Running: %s', cmd)
-
-            proc = process.Subprocess(cmd, stdout = process.Subprocess.STREAM,
-                                      stderr = process.Subprocess.STREAM,
-                                      cwd = tmpdir)
-            errs = ''
-            self.pid = proc.proc.pid
+            job = dict(
+                gcode = os.path.abspath(self.gcode), state = self.state,
+                config = self.config, dir = tmpdir,
+                args = dict(max_time = self.preplanner.max_plan_time,
+                            max_loop = self.preplanner.max_loop_time))
 
-            try:
-                try:
-                    while True:
-                        line = yield proc.stdout.read_until(b'\n')
-                        self.progress = float(line.strip())
-                        if self.cancel: return
-                except iostream.StreamClosedError: pass
+            self.preplanner.log.info('Planning: %s', job['gcode'])
+
+            worker = self.preplanner.get_worker()
+            self.pid = worker.pid # Killed on terminate()
+            self.tmpdir = tmpdir
 
-                self.progress = 1
+            try:
+                yield worker.plan(job, self._update)
 
-                ret = yield proc.wait_for_exit(False)
-                if ret and not self.cancel:
-                    errs = yield proc.stderr.read_until_close()
-                    raise Exception('Plan failed: ' + errs.decode('utf8'))
+            except:
+                if self.cancel: return
+                raise
 
             finally:
-                proc.stderr.close()
-                proc.stdout.close()
+                self.pid = None
+                self.tmpdir = None
+                self.preplanner.put_worker(worker)
+
+            self.progress = 1
 
             if not self.cancel:
                 shutil.move(tmpdir + '/meta.json',    self.files[0])
                 shutil.move(tmpdir + '/positions.gz', self.files[1])
                 shutil.move(tmpdir + '/speeds.gz',    self.files[2])
-                self.preplanner.clean()
+                shutil.move(tmpdir + '/profile.gz',   self.files[3])
+                self.preplanner.cache.add(self.key, self.path)
                 os.sync()
 
 
+    def _update(self, msg):
+        if 'progress' in msg: self.progress = msg['progress']
+        if 'chunk' in msg: self.chunks.append(msg['chunk'])
+
+
+    def read_stream(self, dataType, points):
+        # Returns data after points, the points read and if planning is done
+        index, size = (1, 12) if dataType == 'positions' else (2, 4)
+        tmpdir, chunks = self.tmpdir, self.chunks
+
+        if tmpdir is None:
+            if not self.files or not self._exists():
+                return b'', points, False # Not started
+
+            data, offset = self._read_planned(dataType, index, points * size)
+            return data, offset // size, True
+
+        # Inflate the chunks after the last boundary at or before points
+        i = bisect.bisect_right([chunk[0] for chunk in chunks], points) - 1
+        if i < 0 or i == len(chunks) - 1: return b'', points, False
+        start, end = chunks[i][index], chunks[-1][index]
+
+        with open(tmpdir + '/' + dataType + '.gz', 'rb') as f:
+            f.seek(start)
+            data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+                f.read(end - start))
+
+        return data[(points - chunks[i][0]) * size:], chunks[-1][0], False
+
+
+    def _read_planned(self, dataType, index, start):
+        # Continue from the last read of this stream unless behind it
+        f, offset = self.readers.get(dataType, (None, 0))
+        if f is None or start < offset:
+            if f is not None: f.close()
+            f, offset = gzip.open(self.files[index], 'rb'), 0
+
+        if offset < start: offset += len(f.read(start - offset))
+        data = f.read()
+        offset += len(data)
+        self.readers[dataType] = (f, offset)
+
+        return data, offset
+
+
+    def _set_gcode(self, gcode, digest):
+        self.gcode = gcode
+        self.hid = plan_hash(digest, self.config)
+        self.key = '%s.%s.' % (os.path.basename(self.path), self.hid)
+        self.files = self.preplanner.cache.get_files(self.key)
+
+
+    def read_profile(self, meta):
+        with gzip.open(self.files[3], 'rb') as f: data = f.read()
+        fields = meta['profile']['fields']
+
+        return [dict(zip(fields, record)) for record in
+                struct.iter_unpack(meta['profile']['format'], data)]
+
+
     @gen.coroutine
     def _load(self):
         try:
+            # TPL programs are planned from their rendered G-code
+            gcode = yield self.ctrl.tpl.render(self.path)
+            digest = yield self.ctrl.hashes.get(gcode)
+            if self.cancel:
+                self.future.set_result(None)
+                return
+
+            self._set_gcode(gcode, digest)
+
             if self._exists():
                 data = self._read()
                 if data is not None:
@@ -192,35 +325,101 @@ class Plan(object):
 
 
 class Preplanner(object):
+    # Plan priorities, lowest first
+    ACTIVE     = 0 # The running program
+    SELECTED   = 1 # Requested by a client
+    BACKGROUND = 2
+
     def __init__(self, ctrl, max_plan_time = 60 * 60 * 24, max_loop_time = 300):
         self.ctrl = ctrl
         self.log = ctrl.log.get('Preplanner')
 
         self.max_plan_time = max_plan_time
         self.max_loop_time = max_loop_time
+        self.max_workers = ctrl.args.preplanner_workers
+        self.max_temp = ctrl.args.preplanner_max_temp
+        self.waiting = []
+        self.running = set()
+        self.workers = [] # Idle plan.py processes
+        self.seq = 0
 
         path = self.ctrl.get_plan()
         if not os.path.exists(path): os.mkdir(path)
+        self.cache = PlanCache(ctrl)
 
         self.started = Future()
         self.plans = {}
 
         ctrl.events.on('invalidate-all', self.invalidate_all)
         ctrl.events.on('invalidate', self.invalidate)
+        ctrl.state.add_listener(self._update)
+
+
+    def _update(self, update):
+        if 'cycle' in update or 'rpi_temp' in update: self._schedule()
+
+
+    def _get_workers(self):
+        workers = self.max_workers
+        if not workers: workers = max(1, (os.cpu_count() or 1) - 2)
+
+        # Leave the CPU to the controller while hot or running a program
+        state = self.ctrl.state
+        if self.max_temp <= state.get('rpi_temp', 0): workers = 1
+        if state.get('cycle', 'idle') != 'idle': workers = 1
+
+        return workers
+
+
+    def _rank(self, plan):
+        priority = plan.priority
 
+        if plan.path == self.ctrl.state.get('active_program', ''):
+            priority = Preplanner.ACTIVE
 
-    def clean(self, max = 100):
-        plans = glob.glob('%s/plans/*.json' % self.ctrl.root)
-        if len(plans) <= max: return
+        # Clients stop polling plans they no longer show
+        elif (priority == Preplanner.SELECTED and
+              plan.requested + 10 < time.time()):
+            priority = Preplanner.BACKGROUND
 
-        # Delete oldest plans
-        plans = [(os.path.getmtime(path), path) for path in plans]
-        plans.sort()
+        return priority, -plan.seq # Most recently requested first
 
-        for mtime, path in plans[:len(plans) - max]:
-            safe_remove(path)
-            safe_remove(path[:-4] + 'positions.gz')
-            safe_remove(path[:-4] + 'speeds.gz')
+
+    def _schedule(self):
+        while len(self.waiting) and len(self.running) < self._get_workers():
+            plan = min(self.waiting, key = self._rank)
+            self.waiting.remove(plan)
+            self.running.add(plan)
+            plan.slot.set_result(True)
+
+
+    def acquire(self, plan):
+        plan.slot = Future()
+        self.waiting.append(plan)
+        self._schedule()
+        return plan.slot
+
+
+    def release(self, plan):
+        self.running.discard(plan)
+        self._schedule()
+
+
+    def get_worker(self):
+        if len(self.workers): return self.workers.pop()
+        return Worker(self)
+
+
+    def put_worker(self, worker):
+        if worker.is_alive(): self.workers.append(worker)
+        else: worker.close()
+
+
+    def dequeue(self, plan):
+        # Cancel a plan waiting for a worker
+        if plan in self.waiting:
+            self.waiting.remove(plan)
+            plan.slot.set_result(False)
 
 
     def start(self):
@@ -230,6 +429,8 @@ class Preplanner(object):
 
 
     def invalidate(self, path):
+        self.cache.remove_source(path)
+
         if path in self.plans:
             self.plans[path].terminate()
             del self.plans[path]
@@ -242,7 +443,7 @@ class Preplanner(object):
 
 
     @gen.coroutine
-    def get_plan(self, path):
+    def get_plan(self, path, priority = BACKGROUND):
         if path is None: raise Exception('Path cannot be None')
 
         # Wait until state is fully initialized
@@ -250,14 +451,42 @@ class Preplanner(object):
 
         if not self.ctrl.fs.isfile(path): raise Exception('File not found')
 
+        # Plan again if its files were evicted
+        if path in self.plans and self.plans[path].is_evicted():
+            self.plans.pop(path).terminate()
+
         if path in self.plans: plan = self.plans[path]
         else:
             plan = Plan(self, self.ctrl, path)
             self.plans[path] = plan
 
+        self.seq += 1
+        plan.request(priority, self.seq)
+
         data = yield plan.future
         return data
 
 
+    @gen.coroutine
+    def get_profile(self, path, priority = BACKGROUND):
+        data = yield self.get_plan(path, priority)
+        if data is None or not path in self.plans: return
+        return self.plans[path].read_profile(data[0])
+
+
     def get_plan_progress(self, path):
         return self.plans[path].progress if path in self.plans else 0
+
+
+    def get_stream(self, path, dataType, points):
+        if not path in self.plans: return b'', points, False
+        return self.plans[path].read_stream(dataType, points)
+
+
+    def get_plan_queue(self, path):
+        # Position waiting for a worker, 0 if not waiting
+        plan = self.plans.get(path)
+        if plan is None or not plan in self.waiting: return 0
+
+        waiting = sorted(self.waiting, key = self._rank)
+        return waiting.index(plan) + 1
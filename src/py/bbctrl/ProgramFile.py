@@ -34,13 +34,15 @@ class ProgramFile(Program):
   status = 'running'
 
 
-  def __init__(self, ctrl, path, with_start = True):
+  def __init__(self, ctrl, path, with_start = True, checkpoint = None):
     super().__init__(ctrl)
     self.path = path
     self.with_start = with_start
+    self.checkpoint = checkpoint
 
 
   def start(self, mach, planner):
-    planner.load(lambda: mach.end(self), self.path, None, self.with_start, True)
+    planner.load(lambda: mach.end(self), self.path, None, self.with_start, True,
+                 self.checkpoint)
     mach.resume()
     return True
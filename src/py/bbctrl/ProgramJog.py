@@ -42,6 +42,6 @@ class ProgramJog(Program):
 
 
   def start(self, mach, planner):
-    mach.queue_command(Cmd.jog(self.id, self.axes))
+    mach.queue_command(Cmd.jog(self.id, self.axes), key = Cmd.JOG)
     mach.planner.position_change()
     return True
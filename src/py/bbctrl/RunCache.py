@@ -0,0 +1,163 @@
+################################################################################
+#                                                                              #
+#                 This file is part of the Buildbotics firmware.               #
+#                                                                              #
+#        Copyright (c) 2015 - 2021, Buildbotics LLC, All rights reserved.      #
+#                                                                              #
+#         This Source describes Open Hardware and is licensed under the        #
+#                                 CERN-OHL-S v2.                               #
+#                                                                              #
+#         You may redistribute and modify this Source and make products        #
+#    using it under the terms of the CERN-OHL-S v2 (https:/cern.ch/cern-ohl).  #
+#           This Source is distributed WITHOUT ANY EXPRESS OR IMPLIED          #
+#    WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS  #
+#     FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-S v2 for applicable    #
+#                                  conditions.                                 #
+#                                                                              #
+#                Source location: https://github.com/buildbotics               #
+#                                                                              #
+#      As per CERN-OHL-S v2 section 4, should You produce hardware based on    #
+#    these sources, You must maintain the Source Location clearly visible on   #
+#    the external case of the CNC Controller or other product you make using   #
+#                                  this Source.                                #
+#                                                                              #
+#                For more information, email info@buildbotics.com              #
+#                                                                              #
+################################################################################
+
+
+import os
+import glob
+import gzip
+import json
+import hashlib
+
+from .Preplanner import hash_dump, plan_hash, safe_remove
+
+__all__ = ['RunCache', 'Replay']
+
+
+# State the planner starts from, besides the machine position
+run_state_vars = ['metric', 'tool'] + ['offset_' + axis for axis in 'xyzabc']
+
+
+class Replay(object):
+    def __init__(self, path, gcode, config, position):
+        self.f = gzip.open(path, 'rt')
+        self.gcode = gcode
+        self.config = config
+        self.position = position
+        self.base = None # Command ID of the first block
+        self.count = 0   # Blocks replayed
+
+
+    def close(self): self.f.close()
+
+
+    def next(self, next_id):
+        line = self.f.readline()
+        if not line: return
+
+        if self.base is None: self.base = next_id
+
+        block = json.loads(line)
+        block['id'] = (self.base + self.count) & 0xffff
+        self.count += 1
+
+        return block
+
+
+    def index(self, id):
+        # Block index of a replayed command ID, -1 if before the first block
+        if self.base is None: return -1
+        last = (self.base + self.count - 1) & 0xffff
+        return self.count - 1 - ((last - id) & 0xffff)
+
+
+class RunCache(object):
+    def __init__(self, ctrl):
+        self.ctrl = ctrl
+        self.log = ctrl.log.get('RunCache')
+        self.max = ctrl.args.run_cache
+        self.dir = ctrl.get_path('runs')
+        self.f = None
+        self.path = None
+
+        if not os.path.exists(self.dir): os.mkdir(self.dir)
+
+
+    def is_enabled(self, path):
+        # Macro runs are always kept, in addition to the last max programs
+        return 0 < self.max or self.ctrl.macros.is_macro(path)
+
+
+    def is_recording(self): return self.f is not None
+
+
+    def key(self, gcode, config, position):
+        state = self.ctrl.state.get_values(run_state_vars)
+        position = {axis: round(value, 4) for axis, value in position.items()}
+
+        # Hashed before the program is started, see Mach.start()
+        digest = self.ctrl.hashes.lookup(gcode)
+        if digest is None: return
+
+        h = hashlib.sha256()
+        h.update(plan_hash(digest, config).encode('utf8'))
+        h.update(hash_dump([position, state]))
+
+        return h.hexdigest()
+
+
+    def _path(self, key): return '%s/%s.gz' % (self.dir, key)
+
+
+    def replay(self, key, gcode, config, position):
+        path = self._path(key)
+        if not os.path.exists(path): return
+
+        self.log.info('Replaying %s' % key)
+        os.utime(path) # Most recently used
+
+        return Replay(path, gcode, config, position)
+
+
+    def record(self, key):
+        self.abort()
+        self.path = self._path(key)
+        self.f = gzip.open(self.path + '.tmp', 'wt', compresslevel = 1)
+
+
+    def add(self, block):
+        if self.f is not None: self.f.write(json.dumps(block) + '\n')
+
+
+    def abort(self):
+        if self.f is None: return
+        self.f.close()
+        safe_remove(self.path + '.tmp')
+        self.f = None
+
+
+    def save(self):
+        # Called once a recorded program has run to completion
+        if self.f is None: return
+        self.f.close()
+        self.f = None
+
+        os.replace(self.path + '.tmp', self.path)
+        self.log.info('Recorded %s' % os.path.basename(self.path))
+        self._clean()
+
+
+    def _clean(self):
+        macros = set(self._path(key) for key in self.ctrl.macros.get_runs())
+        runs = [path for path in glob.glob(self.dir + '/*.gz')
+                if not path in macros]
+        if len(runs) <= self.max: return
+
+        # Delete least recently used runs
+        runs = [(os.path.getmtime(path), path) for path in runs]
+        runs.sort()
+
+        for mtime, path in runs[:len(runs) - self.max]: safe_remove(path)
@@ -47,6 +47,9 @@ class State(object):
         self.timeout = None
         self.machine_var_set = set()
         self.message_id = 0
+        self.motors = None # Axis to motor map, rebuilt when motors change
+        self.motor_vars = set('%d%s' % (motor, var)
+                              for motor in range(4) for var in ('an', 'me'))
 
         # Defaults
         self.vars = {
@@ -149,6 +152,7 @@ class State(object):
         if not name in self.vars or self.vars[name] != value:
             self.vars[name] = value
             self.changes[name] = value
+            if name in self.motor_vars: self.motors = None
 
             # Trigger listener notify
             if self.timeout is None:
@@ -160,6 +164,10 @@ class State(object):
             self.set(name, value)
 
 
+    def get_values(self, names):
+        return tuple(self.vars.get(name) for name in names)
+
+
     def get(self, name, default = None):
         name = self.resolve(name)
 
@@ -252,11 +260,15 @@ class State(object):
 
 
     def find_motor(self, axis):
-        for motor in range(4):
-            if not ('%dan' % motor) in self.vars: continue
-            motor_axis = 'xyzabc'[self.vars['%dan' % motor]]
-            if motor_axis == axis.lower() and self.vars.get('%dme' % motor, 0):
-                return motor
+        if self.motors is None:
+            self.motors = {}
+
+            for motor in reversed(range(4)): # Lowest motor wins
+                if not ('%dan' % motor) in self.vars: continue
+                if not self.vars.get('%dme' % motor, 0): continue
+                self.motors['xyzabc'[self.vars['%dan' % motor]]] = motor
+
+        return self.motors.get(axis.lower())
 
 
     def is_axis_homed(self, axis): return self.get('%s_homed' % axis, 0)
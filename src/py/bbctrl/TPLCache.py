@@ -0,0 +1,183 @@
+################################################################################
+#                                                                              #
+#                 This file is part of the Buildbotics firmware.               #
+#                                                                              #
+#        Copyright (c) 2015 - 2021, Buildbotics LLC, All rights reserved.      #
+#                                                                              #
+#         This Source describes Open Hardware and is licensed under the        #
+#                                 CERN-OHL-S v2.                               #
+#                                                                              #
+#         You may redistribute and modify this Source and make products        #
+#    using it under the terms of the CERN-OHL-S v2 (https:/cern.ch/cern-ohl).  #
+#           This Source is distributed WITHOUT ANY EXPRESS OR IMPLIED          #
+#    WARRANTY, INCLUDING OF MERCHANTABILITY, SATISFACTORY QUALITY AND FITNESS  #
+#     FOR A PARTICULAR PURPOSE. Please see the CERN-OHL-S v2 for applicable    #
+#                                  conditions.                                 #
+#                                                                              #
+#                Source location: https://github.com/buildbotics               #
+#                                                                              #
+#      As per CERN-OHL-S v2 section 4, should You produce hardware based on    #
+#    these sources, You must maintain the Source Location clearly visible on   #
+#    the external case of the CNC Controller or other product you make using   #
+#                                  this Source.                                #
+#                                                                              #
+#                For more information, email info@buildbotics.com              #
+#                                                                              #
+################################################################################
+
+
+import os
+import glob
+import hashlib
+import tempfile
+from tornado import gen, process
+
+__all__ = ['TPLCache']
+
+
+def is_tpl(path): return os.path.splitext(path)[1].lower() == '.tpl'
+
+
+class TPLCache(object):
+    def __init__(self, ctrl, max_files = 20):
+        self.ctrl = ctrl
+        self.log = ctrl.log.get('TPLCache')
+        self.cmd = ctrl.args.tplang
+        self.max_files = max_files
+        self.rendered = {} # Rendered G-code by TPL path
+
+        self.dir = ctrl.get_path('tpl')
+        if self.cmd and not os.path.exists(self.dir): os.mkdir(self.dir)
+
+        ctrl.events.on('invalidate', self._invalidate)
+        ctrl.events.on('invalidate-all', self._invalidate_all)
+
+
+    def _invalidate(self, path):
+        # Library changes may affect any template
+        if path.startswith('Home/lib/'): self._invalidate_all()
+        else: self.rendered.pop(path, None)
+
+
+    def _invalidate_all(self): self.rendered = {}
+
+
+    def _libs(self):
+        for dir in os.environ.get('TPL_PATH', '').split(':'):
+            if not dir: continue
+
+            for root, dirs, files in os.walk(dir):
+                dirs.sort()
+                for name in sorted(files): yield os.path.join(root, name)
+
+
+    def _key(self, realpath):
+        # tplang only sees the template, its libraries and TPL_PATH.  Machine
+        # config is applied when the rendered G-code is planned.
+        h = hashlib.sha256()
+        h.update(('tpl1 %s %s\0' % (self.cmd,
+                                   os.environ.get('TPL_PATH', ''))).encode())
+
+        for path in [realpath] + list(self._libs()):
+            h.update(path.encode('utf8') + b'\0')
+            with open(path, 'rb') as f: h.update(f.read())
+
+        return h.hexdigest()
+
+
+    def _lookup(self, path, realpath):
+        stat = os.stat(realpath)
+        sig = (stat.st_mtime_ns, stat.st_size)
+
+        if path in self.rendered and self.rendered[path][0] == sig:
+            gcode = self.rendered[path][1]
+            if os.path.exists(gcode): return sig, gcode, True
+
+        gcode = '%s/%s.nc' % (self.dir, self._key(realpath))
+        if os.path.exists(gcode):
+            self.rendered[path] = (sig, gcode)
+            return sig, gcode, True
+
+        return sig, gcode, False
+
+
+    def _clean(self):
+        files = glob.glob(self.dir + '/*.nc')
+        if len(files) <= self.max_files: return
+
+        files = [(os.path.getmtime(path), path) for path in files]
+        files.sort()
+
+        for mtime, path in files[:len(files) - self.max_files]:
+            try:
+                os.unlink(path)
+            except OSError: pass
+
+
+    def _failed(self, path, tmp, e):
+        if tmp is not None and os.path.exists(tmp): os.unlink(tmp)
+
+        if isinstance(e, FileNotFoundError):
+            self.log.warning('TPL rendering disabled, %s: %s' % (self.cmd, e))
+            self.cmd = None
+
+        else: self.log.warning('Failed to render %s: %s' % (path, e))
+
+
+    def _finish(self, path, sig, gcode, tmp, ret):
+        if ret: raise Exception('%s exited with %d' % (self.cmd, ret))
+
+        os.replace(tmp, gcode)
+        self.rendered[path] = (sig, gcode)
+        self.log.info('Rendered %s' % path)
+        self._clean()
+
+        return gcode
+
+
+    def needs_render(self, path):
+        realpath = self.ctrl.fs.realpath(path)
+        if not self.cmd or not is_tpl(realpath) or not os.path.isfile(realpath):
+            return False
+
+        try:
+            return not self._lookup(path, realpath)[2]
+        except Exception: return False
+
+
+    def get(self, path):
+        # Returns the G-code file to plan, the source if not yet rendered
+        realpath = self.ctrl.fs.realpath(path)
+        if not self.cmd or not is_tpl(realpath) or not os.path.isfile(realpath):
+            return realpath
+
+        try:
+            sig, gcode, found = self._lookup(path, realpath)
+            if found: return gcode
+        except Exception as e: self._failed(path, None, e)
+
+        return realpath
+
+
+    @gen.coroutine
+    def render(self, path):
+        # Renders TPL programs once without blocking the ioloop
+        realpath = self.ctrl.fs.realpath(path)
+        if not self.cmd or not is_tpl(realpath) or not os.path.isfile(realpath):
+            return realpath
+
+        tmp = None
+        try:
+            sig, gcode, found = self._lookup(path, realpath)
+            if found: return gcode
+
+            fd, tmp = tempfile.mkstemp(dir = self.dir)
+            with os.fdopen(fd, 'wb') as f:
+                proc = process.Subprocess((self.cmd, realpath), stdout = f)
+
+            ret = yield proc.wait_for_exit(False)
+            return self._finish(path, sig, gcode, tmp, ret)
+
+        except Exception as e: self._failed(path, tmp, e)
+
+        return realpath
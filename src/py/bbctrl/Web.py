@@ -85,6 +85,18 @@ def check_password(password):
     if s.split('$') != current: raise HTTPError(401, 'Wrong password')
 
 
+def check_program_path(ctrl, path):
+    # Program paths start with Home or a USB drive and may not leave them
+    path = os.path.normpath(path).lstrip('/')
+    if path == '..' or path.startswith('../'):
+        raise HTTPError(400, 'Invalid path')
+
+    if not os.path.exists(ctrl.fs.realpath(path)):
+        raise HTTPError(404, 'File not found')
+
+    return path
+
+
 
 class RebootHandler(APIHandler):
     def put_ok(self):
@@ -349,7 +361,7 @@ class PathHandler(APIHandler):
             raise HTTPError(404, 'File not found')
 
         preplanner = self.get_ctrl().preplanner
-        future = preplanner.get_plan(path)
+        future = preplanner.get_plan(path, preplanner.SELECTED)
 
         try:
             delta = datetime.timedelta(seconds = 1)
@@ -357,7 +369,8 @@ class PathHandler(APIHandler):
 
         except gen.TimeoutError:
             progress = preplanner.get_plan_progress(path)
-            self.write_json(dict(progress = progress))
+            queue = preplanner.get_plan_queue(path)
+            self.write_json(dict(progress = progress, queue = queue))
             return
 
         try:
@@ -386,6 +399,78 @@ class PathHandler(APIHandler):
         except tornado.iostream.StreamClosedError as e: pass
 
 
+class StreamHandler(RequestHandler):
+    def get(self, dataType, path):
+        if not os.path.exists(self.get_ctrl().fs.realpath(path)):
+            raise HTTPError(404, 'File not found')
+
+        points = int(self.get_argument('points', 0))
+
+        # Start or prioritize the plan without waiting for it
+        preplanner = self.get_ctrl().preplanner
+        future = preplanner.get_plan(path, preplanner.SELECTED)
+        self.get_ctrl().ioloop.add_future(future, lambda f: f.exception())
+
+        try:
+            data, points, done = preplanner.get_stream(path, dataType, points)
+        except FileNotFoundError: raise HTTPError(404, 'Plan not found')
+
+        progress = 1 if done else preplanner.get_plan_progress(path)
+
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('X-Plan-Points', str(points))
+        self.set_header('X-Plan-Done', '1' if done else '0')
+        self.set_header('X-Plan-Progress', str(progress))
+        self.write(data)
+
+
+class ProfileHandler(APIHandler):
+    sorts = ('time', 'excess', 'slowdowns', 'segments', 'distance')
+
+
+    @gen.coroutine
+    def get(self, path):
+        if not os.path.exists(self.get_ctrl().fs.realpath(path)):
+            raise HTTPError(404, 'File not found')
+
+        top = int(self.get_argument('top', 20))
+        sort = self.get_argument('sort', 'excess')
+        if not sort in self.sorts: raise HTTPError(400, 'Invalid sort')
+
+        preplanner = self.get_ctrl().preplanner
+        future = preplanner.get_profile(path, preplanner.SELECTED)
+
+        try:
+            delta = datetime.timedelta(seconds = 1)
+            profile = yield gen.with_timeout(delta, future)
+
+        except gen.TimeoutError:
+            progress = preplanner.get_plan_progress(path)
+            queue = preplanner.get_plan_queue(path)
+            self.write_json(dict(progress = progress, queue = queue))
+            return
+
+        except FileNotFoundError: raise HTTPError(404, 'Plan not found')
+
+        if profile is None: raise HTTPError(500, 'Plan failed')
+
+        for p in profile:
+            t, d = p['time'], p['distance']
+
+            # Average feeds in units per minute
+            p['feed'] = 60 * d / t if t else 0
+            p['programmed'] = 60 * d / p['nominal'] if p['nominal'] else 0
+            p['excess'] = max(0, t - p['nominal'])
+            p['rate'] = p['segments'] / t if t else 0 # Segments per second
+
+        profile.sort(key = lambda p: p[sort], reverse = True)
+        top = [{k: round(v, 3) for k, v in p.items()} for p in profile[:top]]
+
+        self.write_json(dict(
+            time = round(sum(p['time'] for p in profile), 3),
+            lines = len(profile), top = top))
+
+
 class HomeHandler(APIHandler):
     def put_ok(self, axis, action, *args):
         if axis is not None: axis = ord(axis[1:2].lower())
@@ -402,14 +487,40 @@ class HomeHandler(APIHandler):
 
 class StartHandler(APIHandler):
     def put_ok(self, path):
-        path = os.path.normpath(path)
-        if path.startswith('..'): raise HTTPError(400, 'Invalid path')
-        path = path.lstrip('./')
+        path = check_program_path(self.get_ctrl(), path)
 
-        realpath = self.get_ctrl().fs.realpath(path)
-        if not os.path.exists(realpath): raise HTTPError(404, 'File not found')
+        line = self.json.get('line')
+        if line is not None: line = int(line)
 
-        self.get_ctrl().mach.start(path)
+        self.get_ctrl().mach.start(path, line)
+
+
+class QueueHandler(APIHandler):
+    def get(self): self.write_json(self.get_ctrl().queue.get())
+
+
+    def put(self):
+        if not 'path' in self.json: raise HTTPError(400, 'Missing "path"')
+
+        path = check_program_path(self.get_ctrl(), self.json['path'])
+
+        pause = bool(self.json.get('pause', False))
+        self.write_json(self.get_ctrl().queue.add(path, pause))
+
+
+    def delete_ok(self): self.get_ctrl().queue.clear()
+
+
+class QueueJobHandler(APIHandler):
+    def delete_ok(self, id): self.get_ctrl().queue.remove(int(id))
+
+
+class QueueStartHandler(APIHandler):
+    def put_ok(self): self.get_ctrl().queue.start()
+
+
+class QueueHoldHandler(APIHandler):
+    def put_ok(self): self.get_ctrl().queue.hold()
 
 
 class EStopHandler(APIHandler):
@@ -616,8 +727,14 @@ class Web(tornado.web.Application):
             (r'/api/(path)/(.*)',               PathHandler),
             (r'/api/(positions)/(.*)',          PathHandler),
             (r'/api/(speeds)/(.*)',             PathHandler),
+            (r'/api/profile/(.*)',              ProfileHandler),
+            (r'/api/stream/(positions|speeds)/(.*)', StreamHandler),
             (r'/api/home(/[xyzabcXYZABC]((/set)|(/clear))?)?', HomeHandler),
             (r'/api/start/(.*)',                StartHandler),
+            (r'/api/queue',                     QueueHandler),
+            (r'/api/queue/(\d+)',               QueueJobHandler),
+            (r'/api/queue/start',               QueueStartHandler),
+            (r'/api/queue/hold',                QueueHoldHandler),
             (r'/api/estop',                     EStopHandler),
             (r'/api/clear',                     ClearHandler),
             (r'/api/stop',                      StopHandler),
@@ -42,6 +42,41 @@ def _parse_args():
                         help = 'Serial device')
     parser.add_argument('-b', '--baud', default = 230400, type = int,
                         help = 'Serial baud rate')
+    parser.add_argument('--serial-batch', default = 512, type = int,
+                        help = 'Maximum bytes of commands batched per serial '
+                        'write')
+    parser.add_argument('--planner-lookahead', default = 64, type = int,
+                        help = 'Maximum planner commands encoded ahead of the '
+                        'serial writer')
+    parser.add_argument('--eta-period', default = 1, type = float,
+                        help = 'Seconds between program ETA updates, 0 to '
+                        'disable')
+    parser.add_argument('--run-cache', default = 0, type = int,
+                        help = 'Record and replay up to this many planned '
+                        'program runs, 0 to disable')
+    parser.add_argument('--preplanner-workers', default = 0, type = int,
+                        help = 'Maximum simultaneous preplanner processes, 0 '
+                        'for two less than the CPU count')
+    parser.add_argument('--preplanner-max-temp', default = 75, type = float,
+                        help = 'Run one preplanner process at a time above '
+                        'this CPU temperature in C')
+    parser.add_argument('--plan-cache-size', default = 512, type = float,
+                        help = 'Maximum MiB of preplanned toolpaths kept on '
+                        'disk')
+    parser.add_argument('--tplang', default = 'tplang',
+                        help = 'TPL to G-code renderer used to cache TPL '
+                        'programs, empty to disable')
+    parser.add_argument('--motion-thread', action = 'store_true',
+                        help = 'Run serial I/O with the AVR in its own thread')
+    parser.add_argument('--motion-priority', default = 10, type = int,
+                        help = 'Real-time priority of the motion thread, 0 to '
+                        'disable')
+    parser.add_argument('--disable-frames', action = 'store_true',
+                        help = 'Send planner commands to the AVR as text '
+                        'instead of binary frames')
+    parser.add_argument('--serial-capture', metavar = 'FILE',
+                        help = 'Record all AVR serial traffic to a capture '
+                        'file')
     parser.add_argument('--i2c-port', default = 1, type = int,
                         help = 'I2C port')
     parser.add_argument('--lcd-addr', default = [0x27, 0x3f], type = int,
@@ -52,6 +87,10 @@ def _parse_args():
                         help = 'Verbose output')
     parser.add_argument('-l', '--log', metavar = "FILE",
                         help = 'Set a log file')
+    parser.add_argument('--log-budget', metavar = 'NAME=RATE[/N]',
+                        action = 'append', default = [],
+                        help = 'Limit debug and info messages from a logger '
+                        'to RATE per second and one in N, e.g. Planner=20/10')
     parser.add_argument('--disable-camera', action = 'store_true',
                         help = 'Disable the camera')
     parser.add_argument('--width', default = 640, type = int,
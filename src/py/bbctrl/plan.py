@@ -35,8 +35,11 @@ import math
 import os
 import re
 import gzip
+import zlib
 import struct
 import math
+import resource
+import traceback
 import bbctrl.camotics as camotics # pylint: disable=no-name-in-module,import-error
 
 
@@ -47,10 +50,36 @@ reLogLine = re.compile(
     r'((?P<column>\d+):)?'
     r'(?P<msg>.*)$')
 
+reComment = re.compile(r'\([^)]*\)|;.*')
+reWord = re.compile(r'([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+
+# Modal G-code groups restored at checkpoints
+modal_groups = dict(
+    plane    = (17, 18, 19),
+    units    = (20, 21),
+    cutter   = (40, 41, 42),
+    distance = (90, 91),
+    feedmode = (93, 94, 95),
+    coords   = (54, 55, 56, 57, 58, 59, 59.1, 59.2, 59.3),
+    length   = (43, 49))
+
+motion_codes = (0, 1, 2, 3)
+
 
 def clock(): return time.process_time()
 
 
+def report(**msg):
+    sys.stdout.write(json.dumps(msg, separators = (',', ':')) + '\n')
+    sys.stdout.flush()
+
+
+# Records in profile.gz, one per G-code line
+profile_format = '<IfffII'
+profile_fields = ('line', 'time', 'distance', 'nominal', 'segments',
+                  'slowdowns')
+
+
 def compute_unit(a, b):
     unit = dict()
     length = 0
@@ -105,7 +134,14 @@ class Plan(object):
         self.currentSpeed = None
         self.lastProgress = None
         self.lastProgressTime = 0
+        self.lastChunkTime = 0
         self.time = 0
+        self.axes = {}
+        self.tool = None
+        self.checkpoints = []
+        self.line_times = dict(line = [], time = [])
+        self.feed = 0
+        self.profile = {} # Per line machine time, distance, etc.
 
 
     def add_to_bounds(self, axis, value):
@@ -124,6 +160,113 @@ class Plan(object):
         return self.bounds
 
 
+    def add_line_time(self, line):
+        # Plan time at the start of lines, at most one entry per time step
+        lines, times = self.line_times['line'], self.line_times['time']
+
+        if len(lines):
+            if line <= lines[-1]: return
+            if self.time - times[-1] < args.line_time_step: return
+
+        lines.append(line)
+        times.append(round(self.time, 3))
+
+
+    def add_profile(self, line, cmd, distance):
+        p = self.profile.get(line)
+        if p is None: p = self.profile[line] = [0, 0, 0, 0, 0]
+
+        t = sum(cmd['times']) / 1000
+        p[0] += t
+        p[1] += distance
+        p[3] += 1
+
+        # Time at the programmed feed and junctions well below it
+        if cmd.get('rapid', False) or not self.feed: p[2] += t
+        else:
+            p[2] += 60 * distance / self.feed
+            if cmd['exit-vel'] < self.feed * args.slowdown_ratio: p[4] += 1
+
+
+    def write_profile(self):
+        with gzip.open('profile.gz', 'wb') as f:
+            for line in sorted(self.profile):
+                f.write(struct.pack(profile_format, line, *self.profile[line]))
+
+
+    def checkpoint(self, line):
+        # Planner state before the line, the G-code state is added later
+        last = self.checkpoints[-1] if self.checkpoints else None
+
+        if last is not None:
+            if line <= last['line']: return
+            if (line - last['line'] < args.checkpoint_lines and
+                self.time - last['time'] < args.checkpoint_time): return
+
+        elif line <= 1: return
+
+        safe_z = self.bounds['max']['z']
+
+        self.checkpoints.append(dict(
+            line     = line,
+            time     = self.time,
+            position = dict(self.axes),
+            safe_z   = None if safe_z == -math.inf else safe_z,
+            tool     = self.tool,
+            speed    = self.currentSpeed))
+
+
+    def add_gcode_state(self):
+        # Scan the G-code for the modal state and file offset at checkpoints
+        if os.path.splitext(self.path)[1] == '.tpl': # Not rendered to G-code
+            self.checkpoints = []
+            return
+
+        modal = dict(motion = None, spindle = None, coolant = None, feed = None)
+        checkpoints = iter(self.checkpoints)
+        cp = next(checkpoints, None)
+        offset = 0
+
+        with open(self.path, 'rb') as f:
+            for number, line in enumerate(f, 1):
+                while cp is not None and cp['line'] == number:
+                    cp.update(offset = offset, modal = dict(modal))
+                    cp = next(checkpoints, None)
+
+                offset += len(line)
+                line = line.decode('utf8', 'replace').upper()
+                line = reComment.sub('', line)
+
+                # State that cannot be restored from the words seen so far
+                if '#' in line or '[' in line or line.lstrip().startswith('O'):
+                    self.checkpoints = []
+                    return
+
+                for letter, value in reWord.findall(line):
+                    value = float(value)
+
+                    if letter == 'F': modal['feed'] = value
+                    if letter == 'M':
+                        if value in (3, 4, 5): modal['spindle'] = 'M%d' % value
+                        if value in (7, 8, 9): modal['coolant'] = 'M%d' % value
+                        if value in (98, 99): # Subroutine calls
+                            self.checkpoints = []
+                            return
+
+                    if letter != 'G': continue
+                    if value == 92: # Coordinate offsets
+                        self.checkpoints = []
+                        return
+
+                    if value in motion_codes: modal['motion'] = 'G%g' % value
+
+                    for group, codes in modal_groups.items():
+                        if value in codes: modal[group] = 'G%g' % value
+
+        # Drop checkpoints not found in the file
+        self.checkpoints = [cp for cp in self.checkpoints if 'offset' in cp]
+
+
     def update_speed(self, s):
         if self.currentSpeed == s: return False
         self.currentSpeed = s
@@ -189,8 +332,10 @@ class Plan(object):
         if self.lastProgress == p: return
         self.lastProgress = p
 
-        sys.stdout.write(p)
-        sys.stdout.flush()
+        if args.worker: report(progress = float(p))
+        else:
+            sys.stdout.write(p)
+            sys.stdout.flush()
 
 
     def _run(self):
@@ -213,13 +358,14 @@ class Plan(object):
                 if self.planner.is_synchronizing(): self.planner.synchronize(0)
 
                 if cmd['type'] == 'line':
-                    if not (cmd.get('first', False) or
-                            cmd.get('seeking', False)):
-                        self.time += sum(cmd['times']) / 1000
+                    timed = not (cmd.get('first', False) or
+                                 cmd.get('seeking', False))
+                    if timed: self.time += sum(cmd['times']) / 1000
 
                     target = cmd['target']
                     move = {}
                     startPos = dict()
+                    self.axes.update(target)
 
                     for axis in 'xyz':
                         if axis in target:
@@ -228,6 +374,12 @@ class Plan(object):
                             move[axis] = target[axis]
                             self.add_to_bounds(axis, move[axis])
 
+                    if timed:
+                        distance = math.sqrt(sum(
+                            (target[axis] - startPos[axis]) ** 2
+                            for axis in startPos))
+                        self.add_profile(line, cmd, distance)
+
                     if 'rapid' in cmd: move['rapid'] = cmd['rapid']
 
                     if 'speeds' in cmd:
@@ -250,10 +402,15 @@ class Plan(object):
                 elif cmd['type'] == 'set':
                     if cmd['name'] == 'line':
                         line = cmd['value']
+                        self.add_line_time(line)
+                        self.checkpoint(line)
                         if maxLine < line:
                             maxLine = line
                             maxLineTime = clock()
 
+                    elif cmd['name'] == 'tool': self.tool = cmd['value']
+                    elif cmd['name'] == '_feed': self.feed = cmd['value']
+
                     elif cmd['name'] == 'speed':
                         s = cmd['value']
                         if self.update_speed(s): yield {'s': s}
@@ -274,14 +431,26 @@ class Plan(object):
             self.log_cb('error', str(e), os.path.basename(self.path), line, 0)
 
 
+    def flush_chunk(self, f1, f2, points):
+        # Compressed data up to a full flush can be inflated on its own
+        f1.flush(zlib.Z_FULL_FLUSH)
+        f2.flush(zlib.Z_FULL_FLUSH)
+        report(chunk = [points, f1.fileobj.tell(), f2.fileobj.tell()])
+        self.lastChunkTime = time.time()
+
+
     def run(self):
         lastS = 0
         speed = 0
         first = True
         x, y, z = 0, 0, 0
+        points = 0
 
         with gzip.open('positions.gz', 'wb') as f1:
             with gzip.open('speeds.gz', 'wb') as f2:
+                # Stream chunks to the controller while planning
+                if args.worker: self.flush_chunk(f1, f2, points)
+
                 for move in self._run():
                     x = move.get('x', x)
                     y = move.get('y', y)
@@ -293,6 +462,7 @@ class Plan(object):
                     if not first and s != lastS:
                         f1.write(p)
                         f2.write(s)
+                        points += 1
 
                     lastS = s
                     first = False
@@ -300,35 +470,102 @@ class Plan(object):
 
                     f1.write(p)
                     f2.write(s)
+                    points += 1
+
+                    if (args.worker and
+                        args.chunk_time < time.time() - self.lastChunkTime):
+                        self.flush_chunk(f1, f2, points)
+
+        self.add_gcode_state()
+        self.write_profile()
 
         with open('meta.json', 'w') as f:
             meta = dict(
-                time     = self.time,
-                lines    = self.lines,
-                maxSpeed = self.maxSpeed,
-                bounds   = self.get_bounds(),
-                messages = self.messages)
+                time        = self.time,
+                lines       = self.lines,
+                maxSpeed    = self.maxSpeed,
+                bounds      = self.get_bounds(),
+                messages    = self.messages,
+                checkpoints = self.checkpoints,
+                line_times  = self.line_times,
+                profile     = dict(format = profile_format,
+                                   fields = profile_fields))
 
             json.dump(meta, f)
 
 
+def worker():
+    # Plan jobs read from stdin, one JSON message per line
+    jobs = 0
+
+    while True:
+        line = sys.stdin.readline()
+        if not line: break # Controller closed the pipe
+
+        job = json.loads(line)
+        vars(args).update(job.get('args', {}))
+        error = None
+
+        try:
+            os.chdir(job['dir'])
+            Plan(job['gcode'], job['state'], job['config']).run()
+        except Exception: error = traceback.format_exc()
+        finally: os.chdir('/')
+
+        # Recycle after too many jobs or memory growth
+        jobs += 1
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        recycle = args.max_jobs <= jobs or args.max_rss < rss
+
+        report(done = True, error = error, recycle = recycle)
+        if recycle: break
+
+
 parser = argparse.ArgumentParser(description = 'Buildbotics GCode Planner')
-parser.add_argument('gcode', help = 'The GCode file to plan')
-parser.add_argument('state', help = 'GCode state variables')
-parser.add_argument('config', help = 'Planner config')
+parser.add_argument('gcode', nargs = '?', help = 'The GCode file to plan')
+parser.add_argument('state', nargs = '?', help = 'GCode state variables')
+parser.add_argument('config', nargs = '?', help = 'Planner config')
 
 parser.add_argument('--max-time', default = 600,
                     type = int, help = 'Maximum planning time in seconds')
 parser.add_argument('--max-loop', default = 30,
                     type = int, help = 'Maximum time in loop in seconds')
+parser.add_argument('--checkpoint-lines', default = 1000, type = int,
+                    help = 'Maximum G-code lines between checkpoints')
+parser.add_argument('--checkpoint-time', default = 60, type = float,
+                    help = 'Maximum machine time between checkpoints')
+parser.add_argument('--line-time-step', default = 1, type = float,
+                    help = 'Minimum plan time between line time table entries')
+parser.add_argument('--slowdown-ratio', default = 0.5, type = float,
+                    help = 'Count junctions with exit velocity below this '
+                    'fraction of the programmed feed as slowdowns')
 parser.add_argument('--nice', default = 10,
                     type = int, help = 'Set "nice" process priority')
+parser.add_argument('--chunk-time', default = 1, type = float,
+                    help = 'Seconds between streamed chunks in worker mode')
+parser.add_argument('--worker', action = 'store_true',
+                    help = 'Plan jobs read from stdin until it is closed')
+parser.add_argument('--max-jobs', default = 20, type = int,
+                    help = 'Jobs a worker plans before exiting')
+parser.add_argument('--max-rss', default = 256, type = float,
+                    help = 'Worker memory in MiB above which it exits after '
+                    'the current job')
 
 args = parser.parse_args()
 
-state = json.loads(args.state)
-config = json.loads(args.config)
-
 os.nice(args.nice)
-plan = Plan(args.gcode, state, config)
-plan.run()
+
+# Only use CPU time the controller leaves idle
+try:
+    os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+except: pass
+
+if args.worker: worker()
+else:
+    if args.config is None: parser.error('Missing gcode, state or config')
+
+    state = json.loads(args.state)
+    config = json.loads(args.config)
+
+    plan = Plan(args.gcode, state, config)
+    plan.run()